@@ -1,46 +1,97 @@
 
 import os
 import json
+import numpy as np
 
 from backend.utils.logging import get_logger
 from backend.cls.member import Member
 
 class BalanceCalculator:
+    """
+    Columnar balance engine: the spent totals, days spent and balances of the
+    members are kept in numpy arrays (one entry per member, in the order of
+    self.members) so that whole cycles are computed in vectorized form.
+    """
     def __init__(self, expenses_list):
         self.logger = get_logger(BalanceCalculator.__name__)
         # Sufficient to have a list in this case
-        self.members = list(expenses_list.members.values())
+        self.members = list(expenses_list.members)
         self.cycle_length = expenses_list.cycle_length
         self.list = expenses_list
+        self.load_columns()
         self.check_member_data()
 
+    def load_columns(self):
+        """
+        (Re)read the member data into the columns used by the engine.
+        """
+        n = len(self.members)
+        self.spent_totals = np.fromiter((m.spent_total for m in self.members), dtype = float, count = n)
+        self.days_spent = np.fromiter((m.days_spent for m in self.members), dtype = float, count = n)
+        self.balances = np.fromiter((m.balance for m in self.members), dtype = float, count = n)
 
     def check_member_data(self):
-        for m in self.members:
-            if m.days_spent > self.cycle_length:
-                raise ValueError(f"The data for {m.name}, {m.days_spent} days spent, is incompatible with the cycle length of {self.cycle_length} days.")
-        group_days_spent = sum([m.days_spent for m in self.members])
-        if group_days_spent == 0:
+        if self.cycle_length is not None and np.any(self.days_spent > self.cycle_length):
+            m = self.members[int(np.argmax(self.days_spent))]
+            raise ValueError(f"The data for {m.name}, {m.days_spent} days spent, is incompatible with the cycle length of {self.cycle_length} days.")
+        if self.days_spent.sum() == 0:
             self.logger.warning("Group days spent is zero, this will be counted as one to avoid errors.")
     
     def add_member(self, member = None, name = '',spent_total = 0, days_spent = 0):
         if member is None:
             member = Member(name = name,spent_total=spent_total,days_spent=days_spent)
         self.members.append(member)
+        self.spent_totals = np.append(self.spent_totals, member.spent_total)
+        self.days_spent = np.append(self.days_spent, member.days_spent)
+        self.balances = np.append(self.balances, member.balance)
         self.check_member_data()
-        
-    def calculate_balances(self):
-        group_total = sum([m.spent_total for m in self.members])
+
+    @staticmethod
+    def compute_balances(spent_totals, days_spent):
+        """
+        Balances for one cycle (1D arrays, one entry per member) or for a batch
+        of cycles (2D arrays, one row per cycle).
+        """
+        spent_totals = np.asarray(spent_totals, dtype = float)
+        days_spent = np.asarray(days_spent, dtype = float)
+        group_total = spent_totals.sum(axis = -1, keepdims = True)
         # At least 1 to avoid division by zero
-        group_days_spent = max(sum([m.days_spent for m in self.members]),1)
-        daily_expense = group_total/group_days_spent
-        for m in self.members:
-            m.balance = m.spent_total - m.days_spent*daily_expense
-        return [m.balance for m in self.members]
+        group_days_spent = np.maximum(days_spent.sum(axis = -1, keepdims = True), 1)
+        return spent_totals - days_spent*(group_total/group_days_spent)
+        
+    def calculate_balances(self, write_back = True):
+        # The member data may have changed since the columns were read
+        self.load_columns()
+        self.check_member_data()
+        self.balances = self.compute_balances(self.spent_totals, self.days_spent)
+        if write_back:
+            self.write_balances()
+        return self.balances.tolist()
+
+    def calculate_cycles(self, spent_totals, days_spent, write_back = False):
+        """
+        Compute the balances of a batch of cycles at once. Both arguments are
+        (cycles x members) arrays. The balances of each cycle are returned, and
+        if 'write_back' is set their sum is stored as the member balances.
+        """
+        cycle_balances = self.compute_balances(spent_totals, days_spent)
+        if cycle_balances.shape[-1] != len(self.members):
+            raise ValueError(f"Expected data for {len(self.members)} members, got {cycle_balances.shape[-1]}.")
+        if write_back:
+            self.balances = cycle_balances.reshape(-1, len(self.members)).sum(axis = 0)
+            self.write_balances()
+        return cycle_balances
+
+    def write_balances(self):
+        """
+        Write the balances column back to the members.
+        """
+        for m, balance in zip(self.members, self.balances.tolist()):
+            m.balance = balance
     
     def save_balances(self, verbose = False):
-        dict_to_save = {m.name: m.summary() for m in self.members}
-        with open(os.path.join(self.folder_path,'balance_record.json'),'w+') as file:
+        dict_to_save = {m.name: m.balance_summary() for m in self.members}
+        with open(os.path.join(self.list.data_dir,'balance_record.json'),'w+') as file:
             json.dump(dict_to_save,file, indent=4)
         if verbose:
             p = json.dumps(dict_to_save, indent = 4)
@@ -51,4 +102,3 @@ if __name__ == '__main__':
             
 
 
-
@@ -9,6 +9,9 @@ import os
 from backend.utils.const import EUROCENT, STATUS
 from backend.cls.member import Member, MembersList
 from backend.cls.transactions import PendingTransactions, Transaction
+from backend.cls.saveable import Saveable
+from backend.settlement_solver import SettleMode, DEFAULT_TIME_BUDGET, fingerprint, to_cents, min_transfers, greedy_transfers, \
+                                      incremental_adjustments, ADD, AMEND, CANCEL
 
 class BalanceSettler:
     def __init__(self,members = [], folder_path = ''):
@@ -42,7 +45,7 @@ class BalanceSettler:
 
     def check_overall_balance(self):
         overall_balance = 0
-        for m in self.members:
+        for m in self.members.members_by_id.values():
             overall_balance += m.balance
         if abs(overall_balance) > 2*EUROCENT:
             raise ValueError(f"The group debits and credits are not balanced! diff = {overall_balance}")
@@ -64,9 +67,18 @@ class BalanceSettler:
         trans = Transaction(sender = debitor,receiver= creditor,amount=amount)
         self.transactions.add_transaction(trans)
 
-    def generate_settle_up_transactions(self):
+    def generate_settle_up_transactions(self, mode = SettleMode.GREEDY, time_budget = DEFAULT_TIME_BUDGET):
+        """
+        Create the transactions settling up the members. With SettleMode.MIN_TRANSFERS
+        the number of transactions is minimised (see backend.settlement_solver), 
+        'time_budget' bounds the search for large groups.
+        """
         self.check_overall_balance()
         self.generate_event_id()
+        if mode == SettleMode.MIN_TRANSFERS:
+            return self.settle_min_transfers(time_budget)
+        if mode == SettleMode.FAST:
+            return self.settle_fast()
         debitors = self.members.debitors
         creditors = self.members.creditors
         # sort from largest to smallest
@@ -82,24 +94,75 @@ class BalanceSettler:
                 # a bunch of holes, so it's a bit more annoying
                 #creditors = self.sort_members(creditors)[0]
     
+    def settle_min_transfers(self, time_budget = DEFAULT_TIME_BUDGET):
+        members = list(self.members.members_by_id.values())
+        cents = to_cents([self.partial_amounts[m.id] for m in members])
+        self.commit_plan(members, min_transfers(cents, time_budget))
+
+    def settle_fast(self):
+        members = list(self.members.members_by_id.values())
+        cents = to_cents([self.partial_amounts[m.id] for m in members])
+        self.commit_plan(members, greedy_transfers(cents))
+
+    def commit_plan(self, members, transfers):
+        """
+        Turn a plan of (debitor index, creditor index, cents) transfers into 
+        transactions and add them all to the pending transactions in one batch.
+        """
+        transactions = []
+        for d, c, amount in transfers:
+            debitor, creditor = members[d], members[c]
+            amount = amount/100
+            self.partial_amounts[debitor.id] += amount
+            self.partial_amounts[creditor.id] -= amount
+            transactions.append(Transaction(sender = debitor, receiver = creditor, amount = amount))
+        self.transactions.add_transactions(transactions)
+
+    def resettle(self, balance_deltas: dict):
+        """
+        Update the pending transactions after the balances of some members changed
+        by 'balance_deltas' (member id -> change), instead of settling up again from
+        scratch. Only the transactions of the changed members are looked at.
+        Returns the adjustments that were made (see settlement_solver.incremental_adjustments).
+        """
+        ids = list(balance_deltas)
+        cents = to_cents([balance_deltas[m_id] for m_id in ids])
+        pending = {}
+        for m_id in ids:
+            for t in self.transactions.member_transactions(m_id):
+                pending.setdefault((t.sender.id, t.receiver.id), t)
+        plan = {pair: int(round(t.amount*100)) for pair, t in pending.items()}
+        adjustments = incremental_adjustments(plan, dict(zip(ids, cents)))
+
+        new_transactions = []
+        with Saveable.batch():
+            for kind, d_id, c_id, amount in adjustments:
+                if kind == CANCEL:
+                    self.transactions.cancel_transaction(pending[(d_id, c_id)].id)
+                elif kind == AMEND:
+                    self.transactions.amend_transaction(pending[(d_id, c_id)].id, amount/100)
+                else:
+                    new_transactions.append(Transaction(sender = self.members.get_by_id(d_id),
+                                                        receiver = self.members.get_by_id(c_id),
+                                                        amount = amount/100))
+            if new_transactions:
+                self.transactions.add_transactions(new_transactions)
+        return adjustments
+
     def generate_event_id(self):
         """
         Create a unique id that represents this event, characterized
         by THESE members trying to settle up with THESE specific balances
-        and THIS specific configuration of debitors and creditors.
-        This should be pretty safe in ensuring that this id is unique.
+        (the sign of each balance tells debitors and creditors apart).
         """
-        e_id = 0
-        for m in self.members:
-            dc_specifier = 1 if m in self.members.creditors else 2
-            e_id += m.id.numeral*dc_specifier*int(m.balance*100)
+        e_id = fingerprint({m.id : int(round(m.balance*100)) for m in self.members.members_by_id.values()})
         self.transactions.set_event_id(e_id)
 
 
 
     def save_transaction_record(self, verbose = False):
         dict_to_save = {}
-        for m in self.members:
+        for m in self.members.members_by_id.values():
             member_transactions = self.transactions.member_transactions(m.id, event_id = True)
             for t in member_transactions:
                 print(t.POV_str(m.id))
@@ -1,7 +1,8 @@
 from backend.cls.member import Member, MembersList
 import os
 import json
-from backend.cls.list import List
+from backend.cls.list import List, LazyList
+from collections import OrderedDict
 
 from backend.settings import prefs
 from backend.cls.saveable import Saveable
@@ -10,17 +11,25 @@ from backend.cls.saveable import Saveable
 
 class Group(Saveable):
     @Saveable.takes_class_snapshot
-    def __init__(self,name,members: MembersList = None, data_dir = prefs.data_dir, load_from_file = False, load_file_path = ''):
+    def __init__(self,name = '',members: MembersList = None, data_dir = prefs.data_dir, load_from_file = False, load_file_path = '', max_loaded_lists = None):
         super().__init__()
         self.name = name
         self.data_dir = os.path.join(data_dir, 'Group_' + self.id)
         self.file_name = f'{self.id}_group_info.json'
         self.members = MembersList(self,members)
+        # Lists are kept as LazyList handles, at most 'max_loaded_lists' of them
+        # stay loaded at the same time (least recently used ones are unloaded first)
         self.lists = {}
-        self.save_data()
+        self._max_loaded_lists = max_loaded_lists
+        self._loaded_lists = OrderedDict()
+        # Materialized balance and spent total of each member across all the lists,
+        # updated by the lists whenever their items change
+        self._balance_table = {}
 
         if load_from_file:
             group_loaded = self.load(load_file_path)
+        else:
+            self.request_save()
 
 
     @Saveable.affects_metadata(log_msg= "Added new member")
@@ -46,17 +55,77 @@ class Group(Saveable):
             if not member in self.members:
                 raise ValueError(f"Given list contains members not part of this group: "
                                  f"group members: {self.members.names}\nlist members: {new_list.members.names}")
-        if new_list.data_dir != self.data_dir:
+        if os.path.dirname(new_list.data_dir) != self.data_dir:
             self.logger.warning(f"List was previously in a different group/directory: {new_list.data_dir}")
             new_list.change_data_dir(self.data_dir)
-        self.lists[new_list.id] = new_list
+        handle = new_list if isinstance(new_list, LazyList) else LazyList.from_list(new_list)
+        handle._on_access = self._list_accessed
+        self.lists[new_list.id] = handle
+        self._apply_deltas(*handle.get().contributions())
     
     @Saveable.affects_metadata(log_msg="Removed list")
     def remove_list(self,list = None, id = None):
         if id is None:
             id = list.id
+        removed_list = self.lists[id].get()
         self.lists.pop(id)
+        self._loaded_lists.pop(id, None)
+        removed_list.unwatch_items(self)
+        self._apply_deltas(*removed_list.contributions(), sign = -1)
+
+    def _list_accessed(self, handle: LazyList):
+        """
+        Keep track of the most recently used lists and unload the
+        oldest ones when more than 'max_loaded_lists' are loaded.
+        """
+        self._loaded_lists[handle.id] = handle
+        self._loaded_lists.move_to_end(handle.id)
+        handle._list.watch_items(self)
+        if self._max_loaded_lists is None:
+            return
+        while len(self._loaded_lists) > self._max_loaded_lists:
+            _, oldest = self._loaded_lists.popitem(last = False)
+            oldest.unload()
     
+    def list_items_changed(self, changed_list: List, balance_deltas: dict, spent_deltas: dict):
+        """
+        Called by the lists of this group when their items change.
+        """
+        self._apply_deltas(balance_deltas, spent_deltas)
+        self.request_save()
+
+    def _apply_deltas(self, balance_deltas: dict, spent_deltas: dict, sign = 1):
+        for m_id, delta in balance_deltas.items():
+            entry = self._balance_table.setdefault(m_id, {'balance': 0, 'spent_total': 0})
+            entry['balance'] += sign*delta
+        for m_id, delta in spent_deltas.items():
+            entry = self._balance_table.setdefault(m_id, {'balance': 0, 'spent_total': 0})
+            entry['spent_total'] += sign*delta
+
+    def balances(self):
+        """
+        Balance of each member across all the lists of the group.
+        """
+        return {m_id : entry['balance'] for m_id,entry in self._balance_table.items()}
+
+    def spent_totals(self):
+        return {m_id : entry['spent_total'] for m_id,entry in self._balance_table.items()}
+
+    def balance_table(self):
+        return {m_id : dict(entry) for m_id,entry in self._balance_table.items()}
+
+    def rebuild_balances(self):
+        """
+        Recompute the balance table from the items of all the lists (loading them if needed).
+        """
+        self._balance_table = {}
+        for handle in self.lists.values():
+            self._apply_deltas(*handle.get().contributions())
+
+    @property
+    def balances_file_name(self):
+        return self.file_name.replace('group_info', 'group_balances')
+
     def summary(self):
         summary_dict = {
             'name': self.name,
@@ -64,7 +133,7 @@ class Group(Saveable):
             'data_dir': self.data_dir,
             'time_created': self.time_created,
             'lists' : {
-                l.id : os.path.join(l.data_dir,l.file_name) for l in self.lists.values()
+                l.id : l.header_summary() for l in self.lists.values()
             },
             'members': self.members.summary()
         }
@@ -75,6 +144,8 @@ class Group(Saveable):
             os.makedirs(self.data_dir)
         with open(os.path.join(self.data_dir,self.file_name),'w+') as file:
             json.dump(self.summary(),file, indent = 4)
+        with open(os.path.join(self.data_dir,self.balances_file_name),'w+') as file:
+            json.dump(self._balance_table,file, indent = 4)
 
     def load(self, path= None):
         # It's the case when reloading the backend
@@ -88,17 +159,27 @@ class Group(Saveable):
         with open(path,'r') as file:
             data = json.load(file)
             
-        for key,value in data:
+        for key,value in data.items():
             if key == 'members':
-                for m_id, m_dict in value.items():
-                    member = Member(id = m_id)
-                    member.set_data(m_dict)
-                    self.members[m_id] = member
+                self.members.load_members_from_dict(value)
             elif key == 'lists':
-                for l_id, l_path in value.items():
-                    self.lists[l_id] = List(load_from_file=True, load_file_path = l_path)
+                for l_id, header in value.items():
+                    # Older group files only stored the path to each list
+                    if isinstance(header, str):
+                        header = {'path': header}
+                    self.lists[l_id] = LazyList(l_id, header['path'], header, on_access = self._list_accessed)
             else:
                 setattr(self,key,value)
+        self.data_dir = os.path.dirname(path)
+        self.file_name = os.path.basename(path)
+
+        balances_path = os.path.join(self.data_dir, self.balances_file_name)
+        if os.path.exists(balances_path):
+            with open(balances_path,'r') as file:
+                self._balance_table = json.load(file)
+        else:
+            self.logger.warning(f"No balances found for group {self.id}, recomputing them from its lists.")
+            self.rebuild_balances()
         return True
         
         
@@ -1,15 +1,18 @@
 from backend.utils.logging import get_logger
-import os, json
+import os, json, copy
 import typing as ty
+import numpy as np
 
-from backend.cls.member import Member, MembersList
+from backend.cls.member import Member, MembersList, default_weight_name
 from backend.cls.saveable import Saveable
 from backend.utils.const import EUROCENT
 from backend.settings import prefs
 from backend.utils.time import get_timestamp_numerical
 from backend.cls.object_with_id import ObjectWithId
+from backend.utils.fenwick import TemporalIndex
 
 from enum import Enum
+from weakref import WeakSet
 
 PERCENTAGE_MAX_ERROR = 0.01
 
@@ -30,18 +33,47 @@ class ListItem(ObjectWithId):
                  percentages = {}, 
                  amounts = {}, 
                  sharing_weight_name = '',
+                 shares = None,
+                 update_balances = True,
+                 time_created = None,
+                 id = None,
                  **kwargs):
         
         super().__init__()
+        # Roll back the id if one was given as input
+        if id:
+            self.id = id
         self.logger = get_logger(type(self).__name__)
         self.name = name
         self.bought_by = bought_by
         self.amount = amount
+        self.time_created = time_created if time_created else get_timestamp_numerical()
         if members_involved is None:
             members_involved = MembersList(self)
         self.members_involved = members_involved
-        self.shares = self.calculate_shares(sharing_method, percentages, amounts, sharing_weight_name)
-        self.update_member_balances()
+        if shares is None:
+            shares = self.calculate_shares(sharing_method, percentages, amounts, sharing_weight_name)
+        self.shares = shares
+        # Items loaded from file are already accounted for in the member balances
+        if update_balances:
+            self.update_member_balances()
+
+    @classmethod
+    def from_summary(cls, summary: dict, members: MembersList):
+        """
+        Rebuild an item from its summary, taking the members it refers to from 'members'.
+        The item is not applied to the member balances again.
+        """
+        members_involved = MembersList(members = [members.get_by_id(m_id) for m_id in summary['members_involved']])
+        shares = {m_id : share for m_id,(_,share) in zip(summary['members_involved'], summary['shares'])}
+        return cls(summary['name'],
+                   members.get_by_id(summary['bought_by']),
+                   amount = summary.get('amount', sum(shares.values())),
+                   members_involved = members_involved,
+                   shares = shares,
+                   update_balances = False,
+                   time_created = summary.get('time_created'),
+                   id = summary['id'])
 
     def calculate_shares(self,sharing_method, percentages = {}, amounts = {}, sharing_weight_name = ''):
         shares = {}
@@ -69,18 +101,17 @@ class ListItem(ObjectWithId):
             shares = {m : a for m,a in amounts.items()}
         
         elif sharing_method == SharingMethods.WEIGHTED:
-            if not all([hasattr(m,'sharing_weight') for m in self.members_involved]):
-                raise ValueError("Members don't have a weight for this sharing method. Make sure you defined a"
-                                 "sharing weight in your members before using this method.")
-            if all([m.sharing_weights[sharing_weight_name].value == 0 for m in self.members_involved]):
+            sharing_weight_name = sharing_weight_name if sharing_weight_name else default_weight_name
+            ids, weights, weights_sum = self.members_involved.weight_vector(sharing_weight_name)
+            if not weights.any():
                 self.logger.warning("All members have weights = 0, will forcefully set all weights to 1 "
                                     "to avoid ZeroDivisionError")
                 for m in self.members_involved:
                     m.sharing_weights[sharing_weight_name].value = 1
+                ids, weights, weights_sum = self.members_involved.weight_vector(sharing_weight_name)
 
-            weights = [m.sharing_weights[sharing_weight_name].value for m in self.members_involved]
-            share_per_unit_weight = self.amount / sum(weights)
-            shares = {m.id : share_per_unit_weight*weights[i] for i,m in enumerate(self.members_involved) }
+            share_per_unit_weight = self.amount / weights_sum
+            shares = dict(zip(ids, (weights*share_per_unit_weight).tolist()))
 
         return shares
     
@@ -91,25 +122,56 @@ class ListItem(ObjectWithId):
         self.bought_by.add_to_balance(self.amount)
         for m in self.members_involved:
             m.add_to_balance(-self.shares[m.id])
+
+    def revert_member_balances(self):
+        self.bought_by.add_to_spent_total(-self.amount)
+        self.bought_by.add_to_balance(-self.amount)
+        for m in self.members_involved:
+            m.add_to_balance(self.shares[m.id])
+
+    def balance_deltas(self):
+        """
+        Change of each member balance caused by this item.
+        """
+        deltas = {m_id : -share for m_id,share in self.shares.items()}
+        deltas[self.bought_by.id] = deltas.get(self.bought_by.id, 0) + self.amount
+        return deltas
+
+    def spent_deltas(self):
+        return {self.bought_by.id : self.amount}
     
     def edit_field(self,field,value):
         if hasattr(self,field):
             if field == 'members_involved':
                 self.add_member(value)
                 return
+            if field == 'amount' and self.amount:
+                # Keep the same split of the item among its members
+                ratio = value/self.amount
+                self.shares = {m_id : share*ratio for m_id,share in self.shares.items()}
             setattr(self,field,value)
     
     def add_member(self,member):
         self.members_involved.add_member(member)
+
+    def copy(self):
+        """
+        Copy of the item (with the same id) that can be edited without changing this one.
+        """
+        item = copy.copy(self)
+        item.members_involved = MembersList(members = list(self.members_involved))
+        item.shares = dict(self.shares)
+        return item
     
     def summary(self):
         summary_dict = {
             'name': self.name,
             'id': self.id,
             'bought_by': self.bought_by.id,
+            'amount': self.amount,
             'members_involved': [m.id for m in self.members_involved],
             'shares': [(m.name,self.shares[m.id]) for m in self.members_involved],
-            'time_created': get_timestamp_numerical()
+            'time_created': self.time_created
         }
         return summary_dict
     
@@ -119,6 +181,14 @@ class ListItem(ObjectWithId):
 
 default_lists_dir = os.path.join(prefs.data_dir,'ungrouped_lists')
 
+def _add_deltas(total: dict, deltas: dict):
+    for key, delta in deltas.items():
+        total[key] = total.get(key, 0) + delta
+    return total
+
+def _scale_deltas(deltas: dict, factor):
+    return {key : delta*factor for key,delta in deltas.items()}
+
 class List(Saveable):
     @Saveable.takes_class_snapshot
     def __init__(self,name:str = '', 
@@ -136,9 +206,14 @@ class List(Saveable):
         self.group_name = group_name
         self.cycle_length = cycle_length
 
-        self.members = MembersList(self, members)
+        # The members ledger keeps running totals of the balances for check_balance
+        self.members = MembersList(self, members, track_balances = True)
 
         self.items = {}
+        # Objects notified (through 'list_items_changed') of the balance changes caused by items
+        self._item_watchers = WeakSet()
+        # Per-day index of the item balance changes, built on the first time range query
+        self._temporal_index = None
         # To make sure all the required attributes are defined we first
         # define them, then if the list should be loaded from file, we load it.
         if load_from_file:
@@ -147,39 +222,267 @@ class List(Saveable):
     def check_balance(func):
         """
         Decorator to check the balance of the list
-        any time its items are modified
+        any time its items are modified. It only looks at the
+        running totals of the members ledger, see verify().
         """
         def check_balance_wrapper(self,*args,**kwargs):
-            func(*args,**kwargs)
-            list_balance = 0
-            for m in self.members:
-                list_balance += m.balance
-            if abs(list_balance) > 2*EUROCENT:
+            result = func(self,*args,**kwargs)
+            if abs(self.members.ledger.total) > 2*EUROCENT:
                 raise ValueError("List balance is not zero, this is a bug.")
+            return result
         return check_balance_wrapper
+
+    @property
+    def credits(self):
+        return self.members.ledger.credits
+
+    @property
+    def debits(self):
+        return self.members.ledger.debits
+
+    def verify(self):
+        """
+        Recompute the list balance from all the member balances (for debugging),
+        and reset the running totals of the ledger with the result.
+        """
+        list_balance = 0
+        for m in self.members:
+            list_balance += m.balance
+        ledger_balance = self.members.ledger.total
+        self.members.ledger.reset(self.members)
+        if abs(list_balance - ledger_balance) > 2*EUROCENT:
+            self.logger.warning(f"Ledger of list {self.id} drifted from the member balances: "
+                                f"{ledger_balance} != {list_balance}")
+        if abs(list_balance) > 2*EUROCENT:
+            raise ValueError("List balance is not zero, this is a bug.")
+        return True
             
         
     @Saveable.affects_metadata(log_msg="Adding item to list")
     @check_balance 
     def add_item(self,item: ty.Union[dict,ListItem]):
         if not isinstance(item, ListItem):
-            item = ListItem(*item)
+            item = ListItem(**self._prepare_item(item))
         self.items[item.id] = item
+        self._index_item(item)
+        self._items_changed(item.balance_deltas(), item.spent_deltas())
+
+    def watch_items(self, watcher):
+        self._item_watchers.add(watcher)
+
+    def unwatch_items(self, watcher):
+        self._item_watchers.discard(watcher)
+
+    def _items_changed(self, balance_deltas: dict, spent_deltas: dict):
+        for watcher in self._item_watchers:
+            watcher.list_items_changed(self, balance_deltas, spent_deltas)
+
+    def _index_item(self, item: ListItem, sign = 1):
+        if self._temporal_index is None:
+            return
+        self._temporal_index.add(item.time_created, {
+            'balance': _scale_deltas(item.balance_deltas(), sign),
+            'spent_total': _scale_deltas(item.spent_deltas(), sign)
+        })
+
+    def temporal_index(self):
+        """
+        Per-day index of the changes caused by the items (built on first use).
+        """
+        if self._temporal_index is None:
+            points = [(item.time_created, {'balance': item.balance_deltas(), 'spent_total': item.spent_deltas()})
+                      for item in self.items.values()]
+            self._temporal_index = TemporalIndex.from_points(points, channels = ('balance', 'spent_total'))
+        return self._temporal_index
+
+    def balances_between(self, start = None, end = None):
+        """
+        Change of each member balance caused by the items created between the 
+        days 'start' and 'end' (inclusive). Dates, datetimes, ISO date strings
+        and numerical timestamps are accepted, None leaves the range open.
+        """
+        return self.temporal_index().query('balance', start, end)
+
+    def spent_between(self, start = None, end = None):
+        """
+        Amount spent by each member on the items created between the days 'start' and 'end'.
+        """
+        return self.temporal_index().query('spent_total', start, end)
+
+    def _restore_state(self, changes, undo):
+        # Items may have changed, the index will be rebuilt when needed
+        self._temporal_index = None
+        if 'items' not in changes or not self._item_watchers:
+            super()._restore_state(changes, undo)
+            return
+        # Tell the item watchers how the undo/redo changed the balances
+        balances_before, spent_before = self.contributions()
+        super()._restore_state(changes, undo)
+        balances_after, spent_after = self.contributions()
+        _add_deltas(balances_after, _scale_deltas(balances_before, -1))
+        _add_deltas(spent_after, _scale_deltas(spent_before, -1))
+        self._items_changed(balances_after, spent_after)
+
+    def contributions(self):
+        """
+        Total change of the member balances and spent totals caused by the items of this list.
+        """
+        balance_deltas, spent_deltas = {}, {}
+        for item in self.items.values():
+            _add_deltas(balance_deltas, item.balance_deltas())
+            _add_deltas(spent_deltas, item.spent_deltas())
+        return balance_deltas, spent_deltas
+    
+    @Saveable.affects_metadata(log_msg="Adding items to list")
+    @check_balance
+    def add_items(self, items: ty.Iterable[ty.Union[dict,ListItem]]):
+        """
+        Add many items at once. Items are given as dicts of ListItem arguments (already
+        built ListItems are added as they are). All the items are validated before
+        anything changes, equally shared items get their shares computed together, and
+        each member balance is updated (and saved) once with the net change of the batch.
+        """
+        # Items involving all the members share one copy of the member list
+        all_members = self._all_members()
+        prepared, common = [], set()
+        for item in items:
+            if not isinstance(item, ListItem):
+                item = self._prepare_item(item, all_members)
+                if item['members_involved'] is all_members and item.get('shares') is None:
+                    common.add(id(item))
+            prepared.append(item)
+        # Items whose shares were given are booked as they are
+        equal = [kw for kw in prepared if isinstance(kw, dict) and kw.get('shares') is None and
+                 kw.get('sharing_method', SharingMethods.EQUAL) == SharingMethods.EQUAL]
+        if equal:
+            amounts = np.array([kw['amount'] for kw in equal], dtype = float)
+            counts = np.array([len(kw['members_involved']) for kw in equal], dtype = float)
+            for kw, share in zip(equal, (amounts/counts).tolist()):
+                kw['shares'] = dict.fromkeys(kw['members_involved'].ids, share)
+
+        new_items = []
+        balance_deltas = dict.fromkeys(self.members.ids, 0)
+        spent_deltas = {}
+        # Share of the items split equally among all the list members
+        common_share = 0
+        for kw in prepared:
+            if isinstance(kw, ListItem):
+                new_items.append(kw)
+                continue
+            item = ListItem(**kw, update_balances = False)
+            new_items.append(item)
+            buyer_id = item.bought_by.id
+            balance_deltas[buyer_id] += item.amount
+            spent_deltas[buyer_id] = spent_deltas.get(buyer_id, 0) + item.amount
+            if id(kw) in common and kw.get('shares') is not None:
+                common_share += next(iter(item.shares.values()), 0)
+            else:
+                for m_id, share in item.shares.items():
+                    balance_deltas[m_id] -= share
+
+        if common_share:
+            for m_id in balance_deltas:
+                balance_deltas[m_id] -= common_share
+
+        with Saveable.batch():
+            for m_id, amount in spent_deltas.items():
+                self.members.get_by_id(m_id).add_to_spent_total(amount)
+            for m_id, delta in balance_deltas.items():
+                if delta:
+                    self.members.get_by_id(m_id).add_to_balance(delta)
+        for item in new_items:
+            self.items[item.id] = item
+            self._index_item(item)
+        # Items that were already built applied their own balances, 
+        # but the watchers still need to know about them
+        for item in prepared:
+            if isinstance(item, ListItem):
+                _add_deltas(balance_deltas, item.balance_deltas())
+                _add_deltas(spent_deltas, item.spent_deltas())
+        self._items_changed(balance_deltas, spent_deltas)
+        self.logger.debug("Added %d items to list %s", len(new_items), self.id)
+
+    def _all_members(self):
+        """
+        Copy of the list members, for items involving all of them: the item keeps
+        involving these members when more are added to the list. It shares the
+        weight vectors of the list.
+        """
+        return MembersList(members = list(self.members), shared_weights = self.members)
+
+    def _prepare_item(self, item_data: dict, all_members: MembersList = None):
+        """
+        Validate the arguments of a new item, resolving members given by id or name.
+        """
+        kwargs = dict(item_data)
+        for key in ('name', 'bought_by'):
+            if key not in kwargs:
+                raise ValueError(f"Item data is missing '{key}': {item_data}")
+        buyer = self._resolve_member(kwargs['bought_by'])
+        kwargs['bought_by'] = buyer
+        if not isinstance(kwargs.get('amount', 0), (int, float)):
+            raise ValueError(f"Item amount should be a number, got {kwargs['amount']}")
+        kwargs.setdefault('amount', 0)
+        members_involved = kwargs.get('members_involved')
+        if members_involved is None:
+            members_involved = all_members if all_members is not None else self._all_members()
+        elif not isinstance(members_involved, MembersList):
+            members_involved = MembersList(members = [self._resolve_member(m) for m in members_involved])
+        else:
+            for m in members_involved:
+                self._resolve_member(m)
+        if not len(members_involved):
+            raise ValueError(f"Item {kwargs['name']} doesn't involve any member.")
+        shares = kwargs.get('shares')
+        if shares is not None:
+            if set(shares) != set(members_involved.ids):
+                raise ValueError(f"Shares of item {kwargs['name']} should be given for its members "
+                                 f"{members_involved.ids}, got {list(shares)}")
+            if abs(sum(shares.values()) - kwargs['amount']) > EUROCENT:
+                raise ValueError(f"Shares of item {kwargs['name']} add up to {sum(shares.values())} "
+                                 f"instead of its amount {kwargs['amount']}")
+        kwargs['members_involved'] = members_involved
+        return kwargs
+
+    def _resolve_member(self, member: ty.Union[str,Member]):
+        member = self.members.get(member) if isinstance(member, str) else member
+        if member is None or not member in self.members:
+            raise ValueError(f"Member {member} is not part of list {self.name} ({self.id})")
+        return member
     
     @Saveable.affects_metadata(log_msg="Removing item from list")
     @check_balance
     def remove_item(self,id):
         try:
-            self.items.pop(id)
+            item = self.items.pop(id)
         except KeyError:
             self.logger.warning(f"Item not in list {id}")
+            return
+        with Saveable.batch():
+            item.revert_member_balances()
+        self._index_item(item, -1)
+        self._items_changed(_scale_deltas(item.balance_deltas(), -1), _scale_deltas(item.spent_deltas(), -1))
     
     @Saveable.affects_metadata(log_msg="Editing item in list")
     @check_balance
     def edit_item(self,id,key,value):
-        if type(value) != type(self.items[id][key]):
-            raise ValueError(f"Existing key {key}:{self.items[id][key]} has different type than given key {value}")
-        self.items[id].edit_field(key,value)
+        item = self.items[id]
+        if type(value) != type(getattr(item,key)):
+            raise ValueError(f"Existing key {key}:{getattr(item,key)} has different type than given key {value}")
+        balance_deltas = _scale_deltas(item.balance_deltas(), -1)
+        spent_deltas = _scale_deltas(item.spent_deltas(), -1)
+        self._index_item(item, -1)
+        # The edited item replaces the old one, so that undo finds it among the changed items
+        edited = item.copy()
+        with Saveable.batch():
+            item.revert_member_balances()
+            edited.edit_field(key,value)
+            edited.update_member_balances()
+        self.items[id] = item = edited
+        self._index_item(item)
+        _add_deltas(balance_deltas, item.balance_deltas())
+        _add_deltas(spent_deltas, item.spent_deltas())
+        self._items_changed(balance_deltas, spent_deltas)
     
     @check_balance
     def load(self,file_path = ''):
@@ -195,41 +498,23 @@ class List(Saveable):
 
                 elif key == 'items':
                     for id, item in value.items():
-                        item_data = self.preprocess_item_data(item)
-                        
-                        self.items[id] = ListItem(*item_data)
+                        self.items[id] = ListItem.from_summary(item, self.members)
                         
                 elif hasattr(self,key) and not key == 'members':
-                    self.logger.diagnostic(f"Setting list attribute {key} = {value}")
+                    self.logger.diagnostic("Setting list attribute %s = %s", key, value)
                     setattr(self,key,value)
                         
                 self.data_dir = os.path.dirname(file_path)
                 self.file_name = os.path.basename(file_path)
 
-            self.logger.debug(f"Loaded list data from file {file_path}")
+            self.logger.debug("Loaded list data from file %s", file_path)
             return True
         else:
             self.logger.warning(f"Tried to load from non-existing file {file_path}")
             return False
         
-    def preprocess_item_data(self,item_dict):
-        """
-        Since when saving item data we only save ids of users,
-        here we preprocess their ids and return the actual member classes.
-        """
-
-        buyer_id = item_dict['bought_by']
-        item_dict['bought_by'] = self.members.get_by_id(buyer_id)
-
-        members_involved = item_dict['members_involved']
-        item_dict['members_involved'] = {
-            m_id: self.members.get_by_id(m_id) for m_id in members_involved
-        }
-
-        return item_dict
-    
     def save_data(self):
-        self.logger.debug(f"Saving data from list to {self.data_dir}/{self.file_name}")
+        self.logger.debug("Saving data from list to %s/%s", self.data_dir, self.file_name)
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
         dict_to_save = {
@@ -241,7 +526,7 @@ class List(Saveable):
             'items': {item.id: item.summary() for item in self.items.values()},
             
         }
-        self.logger.diagnostic(json.dumps(dict_to_save,indent = 4))
+        self.logger.diagnostic(lambda: json.dumps(dict_to_save,indent = 4))
         file_path = os.path.join(self.data_dir,self.file_name)
         with open(file_path, 'w+') as file:
             json.dump(dict_to_save, file, indent = 4)
@@ -274,3 +559,85 @@ class List(Saveable):
 
         
     
+
+
+class LazyList:
+    """
+    Lightweight handle to a List saved on disk. Only the id, the path to the list file
+    and some header metadata (name, creation time, number of items) are kept in memory,
+    the List itself is loaded the first time any of its other attributes is accessed.
+    """
+    __slots__ = ('id', '_file_path', 'header', '_list', '_on_access')
+
+    def __init__(self, id, file_path, header: dict = None, on_access = None):
+        self.id = id
+        self._file_path = file_path
+        self.header = header if header else {}
+        self._list = None
+        # Called with this handle every time the underlying list is accessed
+        self._on_access = on_access
+
+    @classmethod
+    def from_list(cls, loaded_list: List, on_access = None):
+        handle = cls(loaded_list.id, os.path.join(loaded_list.data_dir, loaded_list.file_name), on_access = on_access)
+        handle._list = loaded_list
+        return handle
+
+    @property
+    def file_path(self):
+        if self._list is not None:
+            return os.path.join(self._list.data_dir, self._list.file_name)
+        return self._file_path
+    
+    data_dir = property(lambda self: os.path.dirname(self.file_path))
+    file_name = property(lambda self: os.path.basename(self.file_path))
+
+    @property
+    def name(self):
+        if self._list is not None:
+            return self._list.name
+        return self.header.get('name', '')
+
+    def is_loaded(self):
+        return self._list is not None
+
+    def get(self) -> List:
+        """
+        Return the underlying List, loading it from file if needed.
+        """
+        if self._list is None:
+            self._list = List(load_from_file = True, load_file_path = self._file_path)
+        if self._on_access is not None:
+            self._on_access(self)
+        return self._list
+    
+    def unload(self):
+        """
+        Drop the loaded list, keeping only the handle data.
+        """
+        if self._list is not None:
+            self.header = self.header_summary()
+            self._file_path = self.file_path
+            self._list = None
+
+    def header_summary(self):
+        if self._list is None:
+            return {**self.header, 'path': self._file_path}
+        return {
+            'path': self.file_path,
+            'name': self._list.name,
+            'time_created': self._list.time_created,
+            'n_items': len(self._list.items)
+        }
+
+    def __getattr__(self, attr):
+        # Don't load the list for special attributes (e.g. when copying the handle)
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in LazyList.__slots__:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.get(), attr, value)
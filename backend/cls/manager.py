@@ -1,11 +1,35 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from backend.balance_calculator import BalanceCalculator
 from backend.balance_settler import BalanceSettler
+from backend.cls.group import Group
+from backend.cls.transactions import PendingTransactions, Transaction
+from backend.settlement_solver import SettleMode, DEFAULT_TIME_BUDGET, fingerprint, to_cents, plan_transfers
+from backend.utils.logging import get_logger
+
+def _plan_settlement(job):
+    """
+    Worker for ProfileManager.settle_balances: only receives and returns
+    plain ids and integer cents so that nothing heavy is pickled.
+    """
+    target_id, cents, mode, time_budget = job
+    start = time.perf_counter()
+    transfers = plan_transfers(cents, mode, time_budget)
+    return target_id, transfers, time.perf_counter() - start
 
 class ProfileManager:
     def __init__(self, user_profile):
+        self.logger = get_logger(type(self).__name__)
         self.user_groups = self.load_user_groups()
         self.user_lists = self.load_user_lists()
         self.user_profile = user_profile
+        # Pending transactions of each settled group/list, by id
+        self.pending = {}
+        # Process pool reused by settle_balances (see close)
+        self._executor = None
+        self._executor_workers = 0
     
 
     def load_profile_data(self):
@@ -17,13 +41,118 @@ class ProfileManager:
     def load_user_lists(self):
         pass
     
+    def get_settleable(self, id):
+        """
+        Group or list of this profile with the given id.
+        """
+        for container in (self.user_groups, self.user_lists):
+            if container and id in container:
+                return container[id]
+        raise ValueError(f"No group or list with id {id} in this profile.")
 
+    def pending_transactions(self, target):
+        if target.id not in self.pending:
+            self.pending[target.id] = PendingTransactions(owner = target)
+        return self.pending[target.id]
 
-    def settle_balances(self, id):
+    @staticmethod
+    def balance_vector(target):
+        """
+        Ids of the members of a group/list and their balances in cents. The member
+        balances are used (as BalanceSettler does), since unlike the balances of the
+        items they include the transactions that were already closed.
+        """
+        members = list(target.members)
+        return [m.id for m in members], to_cents([m.balance for m in members])
+
+    def get_executor(self, max_workers):
+        """
+        Process pool with at least 'max_workers' workers, kept between calls so 
+        that the worker processes are only started once.
+        """
+        if self._executor is None or self._executor_workers < max_workers:
+            self.close()
+            self._executor = ProcessPoolExecutor(max_workers = max_workers)
+            self._executor_workers = max_workers
+        return self._executor
+
+    def close(self):
+        """
+        Shut down the process pool used to settle balances.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_workers = 0
+
+    def settle_balances(self, ids, mode = SettleMode.FAST, max_workers = None, time_budget = DEFAULT_TIME_BUDGET,
+                        executor = None):
         """
         Find the optimal transactions between group members to settle up 
         a group or list balance. If for group remind the user that they
         are balancing across multiple lists.
+        'ids' can be a single id or many of them: plans are computed in parallel
+        (on up to 'max_workers' processes) and committed to the pending transactions 
+        of each group/list one at a time. Returns a report with the timings.
+        The process pool is kept for the next calls (see close), unless an 'executor'
+        is given, in which case it's used instead (and left running).
         """
-        pass
+        if isinstance(ids, str):
+            ids = [ids]
+        start = time.perf_counter()
+        targets, member_ids, balances, jobs = {}, {}, {}, []
+        for id in ids:
+            target = self.get_settleable(id)
+            if isinstance(target, Group):
+                self.logger.info(f"Settling group {target.name}: balances are settled across all of its lists.")
+            targets[id] = target
+            member_ids[id], cents = self.balance_vector(target)
+            jobs.append((id, cents, mode, time_budget))
+            balances[id] = cents
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(jobs))
+        if executor is None and max_workers > 1:
+            executor = self.get_executor(max_workers)
+        if executor is not None:
+            # A few chunks per worker: fewer round trips, still balanced between workers
+            chunksize = max(1, len(jobs)//(max(max_workers, 1)*4))
+            results = executor.map(_plan_settlement, jobs, chunksize = chunksize)
+        else:
+            results = map(_plan_settlement, jobs)
+
+        report = {'groups': {}}
+        n_members = 0
+        for id, transfers, solve_time in results:
+            commit_start = time.perf_counter()
+            committed = self.commit_plan(targets[id], member_ids[id], transfers, balances[id])
+            report['groups'][id] = {
+                'committed': committed,
+                'members': len(member_ids[id]),
+                'transactions': len(transfers),
+                'solve_time': solve_time,
+                'commit_time': time.perf_counter() - commit_start
+            }
+            n_members += len(member_ids[id])
+
+        total_time = time.perf_counter() - start
+        report['total_time'] = total_time
+        report['workers'] = max(max_workers, 1)
+        report['groups_per_second'] = len(jobs)/total_time if total_time else float('inf')
+        report['members_per_second'] = n_members/total_time if total_time else float('inf')
+        self.logger.info(f"Settled {len(jobs)} groups/lists ({n_members} members) in {total_time:.3f}s")
+        return report
 
+    def commit_plan(self, target, member_ids, transfers, cents):
+        pending = self.pending_transactions(target)
+        # Settling the same balances twice doesn't add the transactions again
+        pending.set_event_id(fingerprint(dict(zip(member_ids, cents))))
+        if pending.numb or not transfers:
+            return False
+        transactions = [Transaction(sender = target.members.get_by_id(member_ids[d]),
+                                    receiver = target.members.get_by_id(member_ids[c]),
+                                    amount = amount/100) 
+                        for d, c, amount in transfers]
+        pending.add_transactions(transactions)
+        return True
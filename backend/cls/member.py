@@ -8,19 +8,36 @@ from backend.utils.decorators import requires_reload
 from backend.utils.time import get_timestamp_numerical
 import os, json
 from backend.utils.ids import Id
+from backend.cls.member_store import MemberStore
+from weakref import WeakSet
+import numpy as np
 
-default_members_file = 'all_members.json'
+default_weight_name = 'weight'
 
 class SharingWeight:
     def __init__(self,name, value = 1):
         self.name = name
-        self.value = value
+        # Member owning this weight, notified when the value changes
+        self.owner = None
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        if self.owner is not None:
+            self.owner.weight_changed(self.name)
     
     def tuple(self):
         return (self.name,self.value)
 
 
 class Member(Saveable):
+    # The balance is a property (to notify watchers), but it's part of the member state
+    _undo_properties = ('balance',)
     
     @Saveable.takes_class_snapshot
     def __init__(self,
@@ -29,8 +46,14 @@ class Member(Saveable):
                  balance = 0,
                  spent_total = 0, 
                  sharing_weights = None, 
-                 usr_id = None):
+                 usr_id = None,
+                 days_spent = 0):
         super().__init__()
+        # Objects notified (through 'balance_changed') whenever the balance changes
+        self._balance_watchers = WeakSet()
+        self._balance = 0
+        # Objects notified (through 'weights_changed') whenever a sharing weight changes
+        self._weight_watchers = WeakSet()
         # Id data
         # If a member is initialized through their id (no given name)
         if Id.is_id(name):
@@ -43,7 +66,11 @@ class Member(Saveable):
         self._settled = False
         self.balance = balance
         self.spent_total = spent_total
-        self.sharing_weights = sharing_weights if sharing_weights else [SharingWeight('weight')]      
+        # Days this member took part in the current cycle (see BalanceCalculator)
+        self.days_spent = days_spent
+        # Sharing weights are indexed by name
+        self.sharing_weights = {}
+        self.set_sharing_weights(sharing_weights if sharing_weights else [SharingWeight(default_weight_name)])
         
         loaded_member = self.load(name,id)
         if loaded_member:
@@ -54,14 +81,72 @@ class Member(Saveable):
         if usr_id:
             self.connect_to_usr_profile(usr_id)
 
-        self.logger.debug(f"Initialized member: {name} status: {self.status} for amount: {balance}")
-        self.save_data()
+        self.logger.debug("Initialized member: %s status: %s for amount: %s", name, self.status, balance)
+        self.request_save()
+
+    @property
+    def balance(self):
+        return self._balance
+
+    @balance.setter
+    def balance(self, value):
+        old_value = self._balance
+        self._balance = value
+        for watcher in self._balance_watchers:
+            watcher.balance_changed(self, old_value, value)
+
+    def set_sharing_weights(self, weights):
+        """
+        Replace the sharing weights of this member. Weights can be given as SharingWeight
+        objects, (name, value) tuples or a {name: SharingWeight} dict.
+        """
+        if isinstance(weights, dict):
+            weights = weights.values()
+        self.sharing_weights = {}
+        for weight in weights:
+            if not isinstance(weight, SharingWeight):
+                weight = SharingWeight(*weight)
+            weight.owner = self
+            self.sharing_weights[weight.name] = weight
+        self.weight_changed(None)
+
+    def set_sharing_weight(self, name, value):
+        if name in self.sharing_weights:
+            self.sharing_weights[name].value = value
+        else:
+            weight = SharingWeight(name, value)
+            weight.owner = self
+            self.sharing_weights[name] = weight
+            self.weight_changed(name)
+
+    def weight_changed(self, name):
+        """
+        Notify the watchers that the weight 'name' changed (None for all weights).
+        """
+        for watcher in self._weight_watchers:
+            watcher.weights_changed(self, name)
+
+    def watch_weights(self, watcher):
+        self._weight_watchers.add(watcher)
+
+    def unwatch_weights(self, watcher):
+        self._weight_watchers.discard(watcher)
+
+    def watch_balance(self, watcher):
+        self._balance_watchers.add(watcher)
+
+    def unwatch_balance(self, watcher):
+        self._balance_watchers.discard(watcher)
 
     @property
     def status(self):
-        if abs(self.balance) < EUROCENT:
+        return self.status_of(self.balance)
+
+    @staticmethod
+    def status_of(balance):
+        if abs(balance) < EUROCENT:
             return STATUS.SettledUp
-        elif self.balance > 0:
+        elif balance > 0:
             return STATUS.Creditor
         
         return STATUS.Debitor
@@ -102,11 +187,16 @@ class Member(Saveable):
         
         for key,value in data_dict.items():
             if key == 'sharing_weights':
-                value = [SharingWeight(*v) for v in value]
+                self.set_sharing_weights(value)
+                continue
+            attr = getattr(type(self), key, None)
+            if isinstance(attr, property) and attr.fset is None:
+                # Derived values (e.g. status) are stored for readability only
+                continue
             if hasattr(self,key):
                 setattr(self,key,value)
             else:
-                self.logger.debug(f"Attribute {key} retrieved from data_dict is not in Member class attributes, ignoring it.")
+                self.logger.debug("Attribute %s retrieved from data_dict is not in Member class attributes, ignoring it.", key)
     
     def is_settled(self):
         if not self._settled and abs(self.balance) < EUROCENT:
@@ -136,6 +226,7 @@ class Member(Saveable):
             "balance": self.balance,
             '_settled': self.is_settled(),
             "spent_total": self.spent_total,
+            "days_spent": self.days_spent,
         }
         return summary_dict
     
@@ -148,84 +239,111 @@ class Member(Saveable):
         list-item shares. These should not be imported from groups, since they're not needed.
         """
         summary_dict = self.balance_summary()
-        summary_dict['sharing_weights'] = [weight.tuple() for weight in self.sharing_weights]
+        summary_dict['sharing_weights'] = [weight.tuple() for weight in self.sharing_weights.values()]
         return summary_dict
     
     @Saveable.affects_metadata(log_msg="Renamed member.")
     @requires_reload
     def rename(self,new_name: str):
         print("Renaming member")
-        file_path = os.path.join(prefs.data_dir,default_members_file)
-        # We need to remove the old entry in the all_members file
-        if os.path.exists(file_path):
-            with open(file_path,'r') as file:
-                data_dict = json.load(file)
-            # Check for name clashes
-            if new_name in data_dict['members_from_name']:
-                self.logger.warning("Name would clash with pre-existing member name. Aborting...")
-                return -1
-            if self.id in data_dict['members_from_id'] and self.name in data_dict['members_from_name']:
-                data_dict["members_from_id"].pop(self.id)
-                data_dict['members_from_name'].pop(self.name)
+        store = MemberStore.get_store()
+        # Check for name clashes
+        if store.members_from_name(new_name) is not None:
+            self.logger.warning("Name would clash with pre-existing member name. Aborting...")
+            return -1
+        if self.id in store:
+            store.rename(self.id, new_name)
         self.name = new_name
         return 0
 
 
     def save_data(self):
-        member_dict = self.member_summary()
-        file_path = os.path.join(prefs.data_dir,default_members_file)
-        if os.path.exists(file_path):
-            with open(file_path,'r') as file:
-                data_dict = json.load(file)
-            if self.id in data_dict['members_from_id'] and data_dict['members_from_id'][self.id]['name'] != self.name:
-                raise Exception("Two members share the same id, this is a bug.")
-            
-            data_dict['members_from_id'][self.id] = member_dict
-            data_dict['members_from_name'][self.name] = member_dict
-        else:
-            data_dict = {
-                'members_from_id': {self.id: member_dict},
-                'members_from_name': {self.name: member_dict}
-            }
-            
-        # Member data is only saved in the all_members file, other data 
+        # Member data is only saved in the members registry, other data 
         # structures will only reference the members through their ids.
-        with open(file_path, 'w+') as file:
-            json.dump(data_dict, file, indent=4)
-        self.logger.debug(f"Saved member data for {self.name}, with id: {self.id} to file {file_path}")
+        store = MemberStore.get_store()
+        store.save(self.member_summary())
+        self.logger.debug("Saved member data for %s, with id: %s to %s", self.name, self.id, store.db_path)
 
     def load(self,name = '', id = None):
-        file_path = os.path.join(prefs.data_dir,default_members_file)
-        member_dict = {}
         # When reloading this is the case!
         if not name and not id and len(self.name):
             name = self.name
 
-        if os.path.isfile(file_path):
-            with open(file_path,'r') as file:
-                data = json.load(file)
-                if id and id in data['members_from_id']:
-                    member_dict = data['members_from_id'][id]
-                elif id is None and name in data['members_from_name']:
-                    member_dict = data['members_from_name'][name]
-                else:
-                    self.logger.warning(f"Member {name} with given id: {id} was not found in members file.")
-                    return False
-            if not 'name' in member_dict:
-                raise ValueError(f"Member entry for member {id} doesn't have a name. This should never happen.")
-                
-            for key,value in member_dict.items():
-                setattr(self,key,value)
-            return True
+        store = MemberStore.get_store()
+        if id:
+            member_dict = store.members_from_id(id)
         else:
-            self.logger.debug("Trying to load member data from non-existing file. If you're making a new member it's all good.")
+            member_dict = store.members_from_name(name)
+        if member_dict is None:
+            self.logger.warning(f"Member {name} with given id: {id} was not found in members registry.")
             return False
 
+        for key,value in member_dict.items():
+            setattr(self,key,value)
+        return True
+
+class BalanceLedger:
+    """
+    Running totals of the credits (positive balances) and debits (negative
+    balances) of a set of members, updated whenever one of their balances changes.
+    """
+    def __init__(self):
+        self.credits = 0
+        self.debits = 0
+        self._members = set()
+
+    @property
+    def total(self):
+        return self.credits + self.debits
+
+    def track(self, member: Member):
+        self._members.add(member)
+        member.watch_balance(self)
+        self.balance_changed(member, 0, member.balance)
+
+    def untrack(self, member: Member):
+        self._members.discard(member)
+        member.unwatch_balance(self)
+        self.balance_changed(member, member.balance, 0)
+
+    def sync(self, members):
+        """
+        Track exactly the given members, and recompute the totals.
+        """
+        members = set(members)
+        for member in self._members - members:
+            member.unwatch_balance(self)
+        for member in members - self._members:
+            member.watch_balance(self)
+        self._members = members
+        self.reset(members)
+
+    def balance_changed(self, member, old_value, new_value):
+        self.credits += max(new_value, 0) - max(old_value, 0)
+        self.debits += min(new_value, 0) - min(old_value, 0)
+
+    def reset(self, members):
+        """
+        Recompute the totals from scratch.
+        """
+        balances = [m.balance for m in members]
+        self.credits = sum(b for b in balances if b > 0)
+        self.debits = sum(b for b in balances if b < 0)
+
+
 class MembersList:
-    def __init__(self, owner: Saveable = None, members = None):
+    def __init__(self, owner: Saveable = None, members = None, track_balances = False, shared_weights = None):
         self.logger = get_logger(type(self).__name__)
         self.members_by_id = {}
         self.members_by_name = {}
+        # Running totals of the member balances (only kept if requested)
+        self.ledger = BalanceLedger() if track_balances else None
+        # Weight vectors of the members, by sharing weight name (see weight_vector). Only the
+        # lists of Saveable owners keep them, the ones of the items (which are many) use the
+        # vectors of 'shared_weights' (the list they were copied from) while they have its members
+        self._weight_cache = {}
+        self._caches_weights = isinstance(owner, Saveable)
+        self._shared_weights = shared_weights
         # Reports are only useful for Saveable classes (assured to have a data_dir, even if set to None)
         self.reports_dir = None
         self.owner_id = None
@@ -233,7 +351,10 @@ class MembersList:
             self.reports_dir = os.path.join(owner.data_dir,'balance_summaries')
             self.owner_id = owner.id
         self.summary_type = 'list_summary' if type(owner).__name__ =='List' else 'extended_summary'
-        self.index = 0
+        # Members by status, built the first time they are read (see status_bucket) and then
+        # kept up to date through the balance watchers. Lists that never read them (e.g. the
+        # ones of the list items) don't watch the balances of their members.
+        self._status_buckets = None
         if members:
             assert isinstance(members,(list)), f"Arg. 'members' expected to be of type {type(list)}, got {type(members)}."
             assert type(members[0]) == Member, f"Arg. 'members' must contain {Member} objects"
@@ -242,8 +363,14 @@ class MembersList:
             
     ids = property(lambda self: [id for id in self.members_by_id])
     names = property(lambda self: [name for name in self.members_by_name])
-    debitors = property(lambda self : [m for m in self.members_by_id.values() if m.status == STATUS.Debitor])
-    creditors = property(lambda self : [m for m in self.members_by_id.values() if m.status == STATUS.Creditor])
+    debitors = property(lambda self : self.status_bucket(STATUS.Debitor))
+    creditors = property(lambda self : self.status_bucket(STATUS.Creditor))
+    settled_up = property(lambda self : self.status_bucket(STATUS.SettledUp))
+
+    def status_bucket(self, status):
+        if self._status_buckets is None:
+            self._sync_status_buckets()
+        return list(self._status_buckets[status].values())
 
     def get_by_name(self, name):
         return self.members_by_name[name]
@@ -265,6 +392,80 @@ class MembersList:
     def summary(self):
         return {member.id : getattr(member,self.summary_type)() for member in self}
 
+    def undo_fields(self):
+        """
+        Containers tracked by the undo/redo history of the Saveable owning this list.
+        """
+        return {'members_by_id': self.members_by_id, 'members_by_name': self.members_by_name}
+
+    def undo_restored(self):
+        """
+        Called after an undo/redo changed the containers returned by undo_fields.
+        """
+        if self.ledger is not None:
+            self.ledger.sync(self.members_by_id.values())
+        self._clear_weight_cache()
+        if self._status_buckets is not None:
+            self._sync_status_buckets()
+
+    def balance_changed(self, member, old_value, new_value):
+        """
+        Called by the members of this list when their balance changes.
+        """
+        if self._status_buckets is None:
+            return
+        old_status, new_status = Member.status_of(old_value), Member.status_of(new_value)
+        if old_status != new_status and member.id in self._status_buckets[old_status]:
+            del self._status_buckets[old_status][member.id]
+            self._status_buckets[new_status][member.id] = member
+
+    def _sync_status_buckets(self):
+        for bucket in (self._status_buckets or {}).values():
+            for m_id, member in bucket.items():
+                if m_id not in self.members_by_id:
+                    member.unwatch_balance(self)
+        self._status_buckets = {status: {} for status in STATUS}
+        for member in self.members_by_id.values():
+            member.watch_balance(self)
+            self._status_buckets[member.status][member.id] = member
+
+    def weight_vector(self, weight_name = default_weight_name):
+        """
+        Return the ids of the members, the array of their weights called 'weight_name'
+        and the sum of the weights. The result is cached until a weight or the members change.
+        """
+        shared = self._shared_weights
+        if shared is not None and shared.members_by_id.keys() == self.members_by_id.keys():
+            return shared.weight_vector(weight_name)
+        if not self._caches_weights:
+            return self._compute_weight_vector(weight_name)
+        if weight_name not in self._weight_cache:
+            vector = self._compute_weight_vector(weight_name)
+            if not self._weight_cache:
+                for m in self.members_by_id.values():
+                    m.watch_weights(self)
+            self._weight_cache[weight_name] = vector
+        return self._weight_cache[weight_name]
+
+    def _compute_weight_vector(self, weight_name):
+        ids = tuple(self.members_by_id)
+        try:
+            weights = np.fromiter((m.sharing_weights[weight_name].value for m in self.members_by_id.values()), 
+                                  dtype = float, count = len(ids))
+        except KeyError:
+            raise ValueError(f"Members don't have a weight '{weight_name}' for this sharing method. Make sure you "
+                             "defined a sharing weight in your members before using this method.")
+        return ids, weights, weights.sum()
+
+    def weights_changed(self, member, weight_name):
+        if weight_name is None:
+            self._weight_cache.clear()
+        else:
+            self._weight_cache.pop(weight_name, None)
+
+    def _clear_weight_cache(self):
+        self._weight_cache.clear()
+
     def add_member(self, member: Member):
         if member in self:
             self.logger.warning(f"Member already in MemberList {member.name}{member.id}")
@@ -273,6 +474,12 @@ class MembersList:
             member.involved_in.add(self.owner_id)
         self.members_by_id[member.id] = member
         self.members_by_name[member.name] = member
+        if self.ledger is not None:
+            self.ledger.track(member)
+        if self._status_buckets is not None:
+            member.watch_balance(self)
+            self._status_buckets[member.status][member.id] = member
+        self._clear_weight_cache()
     
     def add_member_from_dict(self,m_dict : dict):
         member = Member(id = m_dict["id"])
@@ -293,6 +500,13 @@ class MembersList:
             member.involved_in.remove(self.owner_id)
         self.members_by_id.pop(member.id)
         self.members_by_name.pop(member.name)
+        if self.ledger is not None:
+            self.ledger.untrack(member)
+        if self._status_buckets is not None:
+            member.unwatch_balance(self)
+            self._status_buckets[member.status].pop(member.id, None)
+        member.unwatch_weights(self)
+        self._clear_weight_cache()
     
     def balance_report(self, save_to_file = False):
         if self.reports_dir is None:
@@ -300,7 +514,7 @@ class MembersList:
             return
 
         bal_report = {
-            m.name : m.balance_summary() for m in self.members_by_name
+            m.name : m.balance_summary() for m in self.members_by_id.values()
         }
         if save_to_file:
             if not os.path.exists(self.reports_dir):
@@ -324,16 +538,7 @@ class MembersList:
         return member.id in self.members_by_id and member.name in self.members_by_name
     
     def __iter__(self):
-        self.index = 0
-        return self
-    
-    def __next__(self):
-        if self.index < len(self.members_by_id):
-            next_item = list(self.members_by_id.values())[self.index]
-            self.index += 1
-            return next_item
-        else:
-            raise StopIteration
+        return iter(self.members_by_id.values())
     
     def __len__(self):
         return len(self.members_by_id)
@@ -0,0 +1,173 @@
+import os
+import json
+import sqlite3
+
+from backend.settings import prefs
+from backend.utils.logging import get_logger
+from backend.utils.name_index import NameIndex
+
+# Legacy registry, only read once to migrate its content to the database.
+default_members_file = 'all_members.json'
+default_members_db = 'all_members.db'
+
+class MemberStore:
+    """
+    Registry of all the members known to the backend. Members are stored in an
+    SQLite database indexed by id and by name, so that saving or looking up a
+    single member costs the same regardless of how many members are registered.
+    Use MemberStore.get_store() to get the (shared) store of a data directory.
+    """
+    _stores = {}
+
+    def __init__(self, data_dir = None):
+        self.logger = get_logger(type(self).__name__)
+        self.data_dir = data_dir if data_dir else prefs.data_dir
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        self.db_path = os.path.join(self.data_dir, default_members_db)
+        # Built on the first name search, then kept up to date by save/rename/remove
+        self._name_index = None
+        self.conn = sqlite3.connect(self.db_path)
+        # WAL + NORMAL sync keeps single record updates cheap while staying crash-safe
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS members ("
+                              "id TEXT PRIMARY KEY, "
+                              "name TEXT NOT NULL, "
+                              "user_id TEXT, "
+                              "time_created TEXT, "
+                              "involved_in TEXT NOT NULL DEFAULT '[]')")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS members_by_name ON members (name)")
+        self.migrate_from_json()
+
+    @staticmethod
+    def get_store(data_dir = None):
+        """
+        Get the store for the given data directory (defaults to the one in the settings).
+        """
+        data_dir = data_dir if data_dir else prefs.data_dir
+        key = os.path.abspath(data_dir)
+        if key not in MemberStore._stores:
+            MemberStore._stores[key] = MemberStore(data_dir)
+        return MemberStore._stores[key]
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        id, name, user_id, time_created, involved_in = row
+        return {
+            'id': id,
+            'name': name,
+            'user_id': user_id,
+            'time_created': time_created,
+            'involved_in': json.loads(involved_in)
+        }
+
+    def members_from_id(self, id):
+        """
+        Return the summary of the member with the given id, or None if it's not registered.
+        """
+        row = self.conn.execute("SELECT id, name, user_id, time_created, involved_in "
+                                "FROM members WHERE id = ?", (id,)).fetchone()
+        return self._to_dict(row)
+
+    def members_from_name(self, name):
+        """
+        Return the summary of the member with the given name, or None if it's not registered.
+        If more members share the same name, the last one that was registered is returned.
+        """
+        row = self.conn.execute("SELECT id, name, user_id, time_created, involved_in "
+                                "FROM members WHERE name = ? ORDER BY rowid DESC LIMIT 1", (name,)).fetchone()
+        return self._to_dict(row)
+
+    def names(self):
+        """
+        Iterate over the names of all registered members.
+        """
+        for (name,) in self.conn.execute("SELECT name FROM members"):
+            yield name
+
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = NameIndex(self.names())
+        return self._name_index
+
+    def search_names(self, query, k = 10, max_typos = 1):
+        """
+        Type-ahead search over the names of all registered members (see NameIndex.search).
+        """
+        return self.name_index().search(query, k, max_typos)
+
+    def save(self, member_dict: dict):
+        """
+        Insert or update (in place) the record of a single member.
+        """
+        existing = self.conn.execute("SELECT name FROM members WHERE id = ?", (member_dict['id'],)).fetchone()
+        if existing is not None and existing[0] != member_dict['name']:
+            raise Exception("Two members share the same id, this is a bug.")
+        with self.conn:
+            self.conn.execute("INSERT INTO members (id, name, user_id, time_created, involved_in) "
+                              "VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT(id) DO UPDATE SET "
+                              "user_id = excluded.user_id, "
+                              "time_created = excluded.time_created, "
+                              "involved_in = excluded.involved_in",
+                              self._to_row(member_dict))
+        if existing is None and self._name_index is not None:
+            self._name_index.add(member_dict['name'])
+
+    def rename(self, id, new_name: str):
+        existing = self.conn.execute("SELECT name FROM members WHERE id = ?", (id,)).fetchone()
+        with self.conn:
+            self.conn.execute("UPDATE members SET name = ? WHERE id = ?", (new_name, id))
+        if existing is not None and self._name_index is not None:
+            self._name_index.remove(existing[0])
+            self._name_index.add(new_name)
+
+    def remove(self, id):
+        existing = self.conn.execute("SELECT name FROM members WHERE id = ?", (id,)).fetchone()
+        with self.conn:
+            self.conn.execute("DELETE FROM members WHERE id = ?", (id,))
+        if existing is not None and self._name_index is not None:
+            self._name_index.remove(existing[0])
+
+    @staticmethod
+    def _to_row(member_dict):
+        return (member_dict['id'],
+                member_dict['name'],
+                member_dict.get('user_id'),
+                member_dict.get('time_created'),
+                json.dumps(list(member_dict.get('involved_in', []))))
+
+    def migrate_from_json(self, file_path = None):
+        """
+        One-shot migration of the legacy all_members.json registry. After its content
+        is imported the file is renamed so that it's not migrated again.
+        """
+        file_path = file_path if file_path else os.path.join(self.data_dir, default_members_file)
+        if not os.path.isfile(file_path):
+            return False
+        with open(file_path,'r') as file:
+            data_dict = json.load(file)
+        # Both maps contain the same summaries, merge them by id
+        members = {}
+        for member_dict in data_dict.get('members_from_name', {}).values():
+            members[member_dict['id']] = member_dict
+        for member_dict in data_dict.get('members_from_id', {}).values():
+            members[member_dict['id']] = member_dict
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO members (id, name, user_id, time_created, involved_in) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  [self._to_row(m) for m in members.values()])
+        self._name_index = None
+        os.replace(file_path, file_path + '.migrated')
+        self.logger.info(f"Migrated {len(members)} members from {file_path} to {self.db_path}")
+        return True
+
+    def __contains__(self, id):
+        return self.conn.execute("SELECT 1 FROM members WHERE id = ?", (id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
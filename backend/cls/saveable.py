@@ -2,24 +2,221 @@ from backend.utils.logging import get_logger
 from backend.utils.time import get_timestamp_numerical, is_valid_timestamp
 from backend.cls.object_with_id import ObjectWithId
 from weakref import WeakSet
+import weakref
 import os
-from copy import deepcopy
+import sys
+import lzma
+import pickle
+import tempfile
+import itertools
+from collections import deque
+from contextlib import contextmanager
+
+# Marks dict keys/attributes that did not exist on one side of a change
+_MISSING = object()
+
+def _freeze(value):
+    """
+    Shallow copy of the containers tracked for undo/redo. The objects
+    they contain are referenced, not copied.
+    """
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, set):
+        return set(value)
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+def _differ(old, new):
+    if old is new:
+        return False
+    try:
+        return bool(old != new)
+    except Exception:
+        return True
+
+class ValueChange:
+    """
+    A field that was set to a different value.
+    """
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def value(self, undo):
+        # Containers are copied so that the stored value is never modified in place
+        return _freeze(self.old if undo else self.new)
+
+    def nbytes(self):
+        return sys.getsizeof(self.old) + sys.getsizeof(self.new)
+
+class DictChange:
+    """
+    Keys of a dict that were added, removed or set to a different value.
+    """
+    def __init__(self, old: dict, new: dict):
+        self.changes = {}
+        for key, value in new.items():
+            old_value = old.get(key, _MISSING)
+            if _differ(old_value, value):
+                self.changes[key] = (old_value, value)
+        for key, value in old.items():
+            if key not in new:
+                self.changes[key] = (value, _MISSING)
+
+    def apply_to(self, container: dict, undo):
+        for key, (old, new) in self.changes.items():
+            value = old if undo else new
+            if value is _MISSING:
+                container.pop(key, None)
+            else:
+                container[key] = value
+
+    def __len__(self):
+        return len(self.changes)
+
+    def nbytes(self):
+        return sys.getsizeof(self.changes) + len(self.changes)*sys.getsizeof((None, None))
+
+class SetChange:
+    """
+    Elements added to or removed from a set.
+    """
+    def __init__(self, old: set, new: set):
+        self.added = new - old
+        self.removed = old - new
+
+    def apply_to(self, container: set, undo):
+        added, removed = (self.removed, self.added) if undo else (self.added, self.removed)
+        container.difference_update(removed)
+        container.update(added)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed)
+
+    def nbytes(self):
+        return sys.getsizeof(self.added) + sys.getsizeof(self.removed)
+
+class ListChange:
+    """
+    Tail of a list that changed after their common prefix.
+    """
+    def __init__(self, old: list, new: list):
+        start = 0
+        while start < min(len(old), len(new)) and not _differ(old[start], new[start]):
+            start += 1
+        self.start = start
+        self.old_tail = old[start:]
+        self.new_tail = new[start:]
+
+    def apply_to(self, container: list, undo):
+        container[self.start:] = self.old_tail if undo else self.new_tail
+
+    def __len__(self):
+        return len(self.old_tail) + len(self.new_tail)
+
+    def nbytes(self):
+        return sys.getsizeof(self.old_tail) + sys.getsizeof(self.new_tail)
+
+def _diff(old, new):
+    """
+    Return the change from the frozen value 'old' to the current value 'new', None if nothing changed.
+    """
+    for container_type, change_type in ((dict, DictChange), (set, SetChange), (list, ListChange)):
+        if type(old) is container_type and isinstance(new, container_type):
+            change = change_type(old, new)
+            return change if len(change) else None
+    if _differ(old, new):
+        return ValueChange(old, _freeze(new))
+    return None
 
 class Version:
-    def __init__(self,state):
-        self.state = state
+    """
+    Changes of the tracked fields of a Saveable between two consecutive snapshots.
+    """
+    # Orders the versions of all the instances by creation
+    _sequence = itertools.count()
+    def __init__(self,changes):
+        self.changes = changes
+        self.sequence = next(Version._sequence)
         self.timestamp = get_timestamp_numerical()
+        # Approximate (shallow) memory used by this version
+        self.size = sys.getsizeof(self) + sys.getsizeof(changes) + \
+                    sum(change.nbytes() for change in changes.values())
+
+class _SpillPickler(pickle.Pickler):
+    """
+    Pickles versions evicted from memory. Objects referenced by the changes
+    (members, items, ...) are stored by reference and not copied, so that
+    undoing a spilled version restores the same objects.
+    """
+    _by_value = (Version, ValueChange, DictChange, SetChange, ListChange)
+
+    def __init__(self, file, refs: dict):
+        super().__init__(file)
+        self.refs = refs
+
+    def persistent_id(self, obj):
+        if obj is _MISSING:
+            return 'missing'
+        if isinstance(obj, self._by_value) or type(obj).__module__ == 'builtins':
+            return None
+        self.refs[id(obj)] = obj
+        return id(obj)
+
+class _SpillUnpickler(pickle.Unpickler):
+    def __init__(self, file, refs: dict):
+        super().__init__(file)
+        self.refs = refs
+
+    def persistent_load(self, pid):
+        if pid == 'missing':
+            return _MISSING
+        return self.refs[pid]
+
+def _release_history(size):
+    Saveable._total_history_bytes -= size[0]
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
 
 class Saveable(ObjectWithId):
     # We track Saveable instances to allow save_all functionality
     _instances = WeakSet()
+    # Unit of work shared by all the instances, see Saveable.batch()
+    _batch_depth = 0
+    _dirty = {}
+    # Undo history budgets, see set_history_budget() and set_global_history_budget()
+    _max_versions = None
+    _max_history_bytes = None
+    _global_max_history_bytes = None
+    _history_spill_dir = None
+    _total_history_bytes = 0
+    # Versions of all the instances in creation order, used to evict the globally oldest ones
+    _history_queue = deque()
+    # Properties (backed by private attributes) that are also tracked by undo/redo
+    _undo_properties = ()
     def __init__(self):
         super().__init__()
         Saveable._instances.add(self)
         self._logger = get_logger(type(self).__name__)
         self._time_created = get_timestamp_numerical()
-        self._version_history = [Version(self._capture_state())]
-        self._current_version = -1
+        # Undo/redo only records the fields that changed between snapshots. The frozen
+        # state of the last snapshot is kept to compute the next difference, and it's
+        # set up by the first snapshot (usually at the end of __init__).
+        self._frozen_state = None
+        self._version_history = []
+        # Number of versions in the history that are currently applied
+        self._current_version = 0
+        # Approximate memory used by the history, released when the instance is collected
+        self._history_size = [0]
+        weakref.finalize(self, _release_history, self._history_size)
+        # Versions evicted to disk (if enabled) and the objects they reference
+        self._spill_path = None
+        self._spilled_versions = 0
+        self._spilled_refs = {}
         self._just_undid_redid = False
         self.data_dir = None
 
@@ -38,7 +235,10 @@ class Saveable(ObjectWithId):
     def takes_class_snapshot(func):
         def wrapper(self,*args,**kwargs):
             func(self,*args,**kwargs)
-            self.logger.debug(f"Saving snapshot of class {type(self).__name__} to allow undo/redo.")
+            if Saveable._batch_depth:
+                self._mark_dirty(version = True)
+                return
+            self.logger.debug("Saving snapshot of class %s to allow undo/redo.", type(self).__name__)
             self.save_version()
         return wrapper
     
@@ -46,8 +246,10 @@ class Saveable(ObjectWithId):
         def outer_wrapper(func):
             def inner_wrapper(self,*args,**kwargs):
                 func(self,*args,**kwargs)
-                msg = f"Saving {type(self).__name__} {self.id} after operation:" + log_msg
-                self.logger.debug(msg)
+                if Saveable._batch_depth:
+                    self._mark_dirty(version = True, data = True)
+                    return
+                self.logger.debug("Saving %s %s after operation:%s", type(self).__name__, self.id, log_msg)
                 self.save_version()
                 self.save_data()
 
@@ -55,60 +257,304 @@ class Saveable(ObjectWithId):
         
         return outer_wrapper
     
+    @staticmethod
+    @contextmanager
+    def batch():
+        """
+        Defer snapshots and persistence of every Saveable modified within the block:
+            with saveable.batch():
+                ...
+        When the (outermost) block exits each modified object takes a single snapshot
+        and is saved once, regardless of how many changes it went through.
+        If the block raises, the modified objects are rolled back to their last
+        snapshot instead, and nothing is saved.
+        """
+        Saveable._batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            Saveable._batch_depth -= 1
+            if Saveable._batch_depth == 0:
+                Saveable._discard_batch()
+            raise
+        Saveable._batch_depth -= 1
+        if Saveable._batch_depth == 0:
+            Saveable._flush_batch()
+
+    transaction = batch
+
+    @staticmethod
+    def _flush_batch():
+        dirty = Saveable._dirty
+        Saveable._dirty = {}
+        for obj, version, data in dirty.values():
+            if version:
+                obj.logger.debug("Saving snapshot of class %s after batch.", type(obj).__name__)
+                obj.save_version()
+            if data:
+                obj.save_data()
+
+    @staticmethod
+    def _discard_batch():
+        dirty = Saveable._dirty
+        Saveable._dirty = {}
+        for obj, _, _ in dirty.values():
+            obj.logger.warning("Batch failed, rolling back the changes to %s %s.", type(obj).__name__, obj.id)
+            obj._rollback()
+
+    def _rollback(self):
+        """
+        Drop the changes made since the last snapshot.
+        """
+        if self._frozen_state is None:
+            return
+        changes = self._diff_state()
+        if changes:
+            self._restore_state(changes, undo = True)
+
+    def _mark_dirty(self, version = False, data = False):
+        entry = Saveable._dirty.setdefault(id(self), [self, False, False])
+        entry[1] = entry[1] or version
+        entry[2] = entry[2] or data
+
+    def request_save(self):
+        """
+        Save data right away, or once the current batch is over.
+        """
+        if Saveable._batch_depth:
+            self._mark_dirty(data = True)
+        else:
+            self.save_data()
+
     def save_version(self):
-        self.logger.debug(self._just_undid_redid)
         # If we're coming after an undo/redo, we shouldn't re-save the snapshot
         if self._just_undid_redid:
             self.logger.debug("Skipping save_version after undo/redo")
             self._just_undid_redid = False
             return
         
-        state = self._capture_state()
-        self.logger.debug("State has changed, saving it.")
+        if self._frozen_state is None:
+            self._frozen_state = self._capture_state()
+            return
+        changes = self._diff_state()
+        if not changes:
+            self.logger.debug("State hasn't changed, no version saved.")
+            return
+        self.logger.debug("State has changed, saving %d changed fields.", len(changes))
         # If we undid something and then changed stuff, reset the version history.
-        if self._current_version < -1:
-            self._version_history = self._version_history[:self._current_version+1]
-        version = Version(state)
+        for version in self._version_history[self._current_version:]:
+            self._account_version(version, -1)
+        del self._version_history[self._current_version:]
+        version = Version(changes)
         self._version_history.append(version)
+        self._current_version = len(self._version_history)
+        self._account_version(version, 1)
+        self._enforce_history_budget()
+        if Saveable._global_max_history_bytes is not None:
+            Saveable._history_queue.append((weakref.ref(self), weakref.ref(version)))
+            Saveable._enforce_global_history_budget()
+
+    @classmethod
+    def set_history_budget(cls, max_versions = None, max_bytes = None):
+        """
+        Limit the undo history of each instance of this class (Saveable for all of them)
+        to 'max_versions' versions and/or roughly 'max_bytes' bytes. The oldest versions
+        are dropped first (or spilled to disk, see set_global_history_budget).
+        """
+        cls._max_versions = max_versions
+        cls._max_history_bytes = max_bytes
+
+    @staticmethod
+    def set_global_history_budget(max_bytes = None, spill_dir = None):
+        """
+        Limit the memory used by the undo history of all instances together. The globally
+        oldest versions are dropped first. If 'spill_dir' is given evicted versions are
+        written there (lzma compressed) instead, and read back when undoing past them.
+        """
+        Saveable._global_max_history_bytes = max_bytes
+        Saveable._history_spill_dir = spill_dir
+        Saveable._history_queue.clear()
+        if max_bytes is None:
+            return
+        # The history that already exists is evicted first
+        versions = sorted(((version.sequence, instance, version) for instance in list(Saveable._instances)
+                           for version in instance._version_history), key = lambda entry: entry[0])
+        Saveable._history_queue.extend((weakref.ref(instance), weakref.ref(version)) 
+                                       for _, instance, version in versions)
+        Saveable._enforce_global_history_budget()
+
+    @staticmethod
+    def history_memory_usage():
+        """
+        Memory used by the undo history, per Saveable type.
+        """
+        usage = {}
+        for instance in list(Saveable._instances):
+            entry = usage.setdefault(type(instance).__name__, 
+                                     {'instances': 0, 'versions': 0, 'bytes': 0, 'spilled_versions': 0})
+            entry['instances'] += 1
+            entry['versions'] += len(instance._version_history)
+            entry['bytes'] += instance._history_size[0]
+            entry['spilled_versions'] += instance._spilled_versions
+        return usage
+
+    def _account_version(self, version, sign):
+        self._history_size[0] += sign*version.size
+        Saveable._total_history_bytes += sign*version.size
+
+    def _enforce_history_budget(self):
+        while self._current_version > 0 and (
+                (self._max_versions is not None and len(self._version_history) > self._max_versions) or
+                (self._max_history_bytes is not None and self._history_size[0] > self._max_history_bytes)):
+            self._evict_oldest_version()
+
+    @staticmethod
+    def _enforce_global_history_budget():
+        queue = Saveable._history_queue
+        max_bytes = Saveable._global_max_history_bytes
+        if max_bytes is None:
+            return
+        while queue and Saveable._total_history_bytes > max_bytes:
+            obj_ref, version_ref = queue.popleft()
+            obj, version = obj_ref(), version_ref()
+            if obj is None or version is None:
+                continue
+            # Versions that were already dropped aren't found, the ones in front of
+            # the version (e.g. loaded back from disk) are older and go first
+            position = next((k for k, v in enumerate(obj._version_history) if v is version), None)
+            if position is None:
+                continue
+            for _ in range(position + 1):
+                if obj._current_version == 0:
+                    break
+                obj._evict_oldest_version()
+
+    def _evict_oldest_version(self):
+        version = self._version_history.pop(0)
+        self._current_version -= 1
+        self._account_version(version, -1)
+        if Saveable._history_spill_dir is not None:
+            self._spill_version(version)
+
+    def _spill_version(self, version):
+        if self._spill_path is None:
+            if not os.path.exists(Saveable._history_spill_dir):
+                os.makedirs(Saveable._history_spill_dir)
+            fd, self._spill_path = tempfile.mkstemp(prefix = f'{type(self).__name__}_{self.id}_',
+                                                    suffix = '.undo.xz', dir = Saveable._history_spill_dir)
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self._spill_path)
+        # Each spilled version is appended as a separate lzma stream
+        with lzma.open(self._spill_path, 'ab') as file:
+            _SpillPickler(file, self._spilled_refs).dump(version)
+        self._spilled_versions += 1
+
+    def _load_spilled_versions(self):
+        """
+        Move the versions spilled to disk back in front of the in-memory history.
+        """
+        versions = []
+        with lzma.open(self._spill_path, 'rb') as file:
+            unpickler = _SpillUnpickler(file, self._spilled_refs)
+            while True:
+                try:
+                    versions.append(unpickler.load())
+                except EOFError:
+                    break
+        open(self._spill_path, 'wb').close()
+        self._spilled_versions = 0
+        self._spilled_refs = {}
+        for version in versions:
+            self._account_version(version, 1)
+        self._version_history[:0] = versions
+        self._current_version += len(versions)
+        self.logger.debug("Loaded %d versions of the undo history from %s", len(versions), self._spill_path)
 
     def undo(self):
-        if len(self._version_history) > 1:
-            if abs(self._current_version) == len(self._version_history):
-                self.logger.debug("Reached the end of version history.")
-                return
-            self.logger.debug("Undoing last changes.")
-            self._current_version -= 1
-            
-            self._set_state()
+        if self._current_version == 0 and self._spilled_versions:
+            self._load_spilled_versions()
+        if self._current_version == 0:
+            self.logger.debug("Reached the end of version history.")
+            return
+        self.logger.debug("Undoing last changes.")
+        self._current_version -= 1
+        self._set_state(self._version_history[self._current_version], undo = True)
 
     
     def redo(self):
-        if len(self._version_history)> 1:
-            if self._current_version == -1:
-                self.logger.debug("Can't redo, reached the latest version.")
-                return
-            self.logger.debug("Redoing last changes.")
-            self._current_version += 1
-            self._set_state()
+        if self._current_version == len(self._version_history):
+            self.logger.debug("Can't redo, reached the latest version.")
+            return
+        self.logger.debug("Redoing last changes.")
+        self._current_version += 1
+        self._set_state(self._version_history[self._current_version-1], undo = False)
             
 
     @affects_metadata(log_msg="Undo/Redo")
-    def _set_state(self):
-        version = self._version_history[self._current_version]
-        self._restore_state(version.state)
+    def _set_state(self, version, undo):
+        self._restore_state(version.changes, undo)
         self._just_undid_redid = True
+
+    def _tracked_fields(self):
+        """
+        Fields recorded for undo/redo: the public attributes of this instance and the
+        properties listed in '_undo_properties'. Attributes holding objects that define
+        'undo_fields' (e.g. MembersList) are tracked through the containers that method
+        returns, keyed by (attribute, field).
+        """
+        fields = {key: getattr(self, key) for key in self._undo_properties}
+        for key, value in vars(self).items():
+            if key.startswith('_'):
+                continue
+            if hasattr(value, 'undo_fields'):
+                for sub_key, sub_value in value.undo_fields().items():
+                    fields[(key, sub_key)] = sub_value
+            else:
+                fields[key] = value
+        return fields
     
     def _capture_state(self):
-        self.logger.debug("Capturing state to add to undo/redo versions")
-        snapshot = deepcopy(self,)
-        return snapshot
+        self.logger.diagnostic("Capturing state to add to undo/redo versions")
+        return {key: _freeze(value) for key, value in self._tracked_fields().items()}
 
-    def _restore_state(self,state):
-        for key,attr in vars(state).items():
-            # TODO: this is not optimal, but it's a small overhead.
-            if key.startswith('_'):
+    def _diff_state(self):
+        changes = {}
+        for key, value in self._tracked_fields().items():
+            old = self._frozen_state.get(key, _MISSING)
+            change = _diff(old, value)
+            if change is None:
+                continue
+            changes[key] = change
+            # Keep the frozen state up to date with the same change
+            if isinstance(change, ValueChange):
+                self._frozen_state[key] = change.value(undo = False)
+            else:
+                change.apply_to(self._frozen_state[key], undo = False)
+        return changes
+
+    def _restore_state(self,changes,undo):
+        restored = set()
+        for key, change in changes.items():
+            if isinstance(change, ValueChange):
+                value = change.value(undo)
+                if value is _MISSING:
+                    delattr(self, key)
+                    self._frozen_state.pop(key, None)
+                    continue
+                setattr(self, key, value)
+                self._frozen_state[key] = change.value(undo)
                 continue
-            setattr(self,key,attr)
+            if isinstance(key, tuple):
+                owner = getattr(self, key[0])
+                container = owner.undo_fields()[key[1]]
+                restored.add(key[0])
+            else:
+                container = getattr(self, key)
+            change.apply_to(container, undo)
+            change.apply_to(self._frozen_state[key], undo)
+        # Let the objects tracked through 'undo_fields' update their derived data
+        for key in restored:
+            getattr(self, key).undo_restored()
     
     def remove_saved_data(self):
         if os.path.exists(self.data_dir):
@@ -0,0 +1,329 @@
+import os
+import io
+import gzip
+import bisect
+import json
+import weakref
+
+from backend.utils.logging import get_logger
+from backend.utils.time import to_timestamp_numerical, get_timestamp_numerical
+
+# Legacy single index of all the segments, split in per-segment index files on load
+index_file_name = 'index.json'
+segment_index_suffix = '.index.json'
+# Records compressed together once appended, see TransactionHistory.seal
+records_per_block = 512
+
+def _fsync_segments(dir_path, segments):
+    for segment in segments:
+        path = os.path.join(dir_path, f'{segment}.jsonl.gz')
+        if os.path.isfile(path):
+            with open(path,'ab') as file:
+                os.fsync(file.fileno())
+    segments.clear()
+
+class TransactionHistory:
+    """
+    Append-only log of closed transactions, partitioned by month (of the closing time)
+    into gzip-compressed segments of one JSON record per line, stored in a directory
+    next to 'file_path' (with the same name, without extension).
+    A small index file next to every segment holds the time range and the members of its
+    records, so that queries only open the segments that can contain matches, and appends
+    only rewrite the index of the segments they touch.
+    Appending only writes the new records, and reading streams the records one
+    at a time, so neither depends on the size of the history.
+    Every append adds a small gzip member at the end of its segment (the open tail). Once
+    the tail holds 'records_per_block' records, or a later month is appended to, it's
+    recompressed as blocks of that many records, whose offsets are kept in the index.
+    The segments are fsynced once every 'sync_every' appends, on sync() and when
+    the history is garbage collected or the interpreter exits.
+    """
+    def __init__(self, file_path, sync_every = 1):
+        self.logger = get_logger(type(self).__name__)
+        self.file_path = file_path
+        self.dir_path = os.path.splitext(file_path)[0]
+        self.sync_every = sync_every
+        self._unsynced = set()
+        self._appends = 0
+        # Appends not synced yet are synced on exit
+        weakref.finalize(self, _fsync_segments, self.dir_path, self._unsynced)
+        self.index = self._load_index()
+        self.migrate_from_json()
+
+    def segment_path(self, segment):
+        return os.path.join(self.dir_path, f'{segment}.jsonl.gz')
+
+    def segment_index_path(self, segment):
+        return os.path.join(self.dir_path, f'{segment}{segment_index_suffix}')
+
+    def _load_index(self):
+        index = {}
+        if not os.path.isdir(self.dir_path):
+            return index
+        for file_name in os.listdir(self.dir_path):
+            if file_name.endswith(segment_index_suffix):
+                with open(os.path.join(self.dir_path, file_name),'r') as file:
+                    entry = json.load(file)
+                entry['members'] = set(entry['members'])
+                index[file_name[:-len(segment_index_suffix)]] = entry
+        legacy_path = os.path.join(self.dir_path, index_file_name)
+        if os.path.isfile(legacy_path):
+            with open(legacy_path,'r') as file:
+                legacy_index = json.load(file)
+            for segment, entry in legacy_index.items():
+                entry['members'] = set(entry['members'])
+                index[segment] = entry
+            self.index = index
+            self._save_index(legacy_index)
+            os.remove(legacy_path)
+        return index
+
+    def _save_index(self, segments):
+        """
+        Write the index files of the given segments.
+        """
+        for segment in segments:
+            entry = self.index[segment]
+            path = self.segment_index_path(segment)
+            with open(path + '.tmp','w') as file:
+                json.dump(dict(entry, members = sorted(entry['members'])), file)
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def record_time(record):
+        # Records written before closing times were stored only have the creation time
+        return record.get('time_closed') or record.get('time_created') or get_timestamp_numerical()
+
+    def append(self, records):
+        """
+        Append the given transaction summaries to the segments of their months.
+        """
+        if not records:
+            return
+        if not os.path.exists(self.dir_path):
+            os.makedirs(self.dir_path)
+        by_segment = {}
+        for record in records:
+            by_segment.setdefault(self.record_time(record)[:6], []).append(record)
+        for segment, segment_records in by_segment.items():
+            # Every append adds a gzip member to the segment, readers see them as a single stream
+            with gzip.open(self.segment_path(segment),'at') as file:
+                file.write(''.join(json.dumps(record) + '\n' for record in segment_records))
+            entry = self.index.setdefault(segment, {'start': None, 'end': None, 'count': 0, 'members': set(),
+                                                    'blocks': [[0, 0]], 'tail_parts': 0})
+            for record in segment_records:
+                time = self.record_time(record)
+                entry['start'] = time if entry['start'] is None else min(entry['start'], time)
+                entry['end'] = time if entry['end'] is None else max(entry['end'], time)
+                entry['members'].update(record[key] for key in ('sender','receiver') if record.get(key))
+            entry['count'] += len(segment_records)
+            entry['tail_parts'] = entry.get('tail_parts', 0) + 1
+            self._unsynced.add(segment)
+        touched = set(by_segment)
+        for segment in by_segment:
+            entry = self.index[segment]
+            if entry['count'] - self._blocks(entry)[-1][1] >= records_per_block:
+                self.seal(segment)
+        # Months before the latest one are closed, their tails won't grow anymore
+        latest = max(by_segment)
+        for segment, entry in self.index.items():
+            if segment < latest and entry.get('tail_parts', 2) > 1:
+                self.seal(segment)
+                touched.add(segment)
+        self._appends += 1
+        if self._appends >= self.sync_every:
+            self.sync()
+        self._save_index(touched)
+        self.logger.debug("Appended %d transactions to %d segments in %s", len(records), len(by_segment), self.dir_path)
+
+    @staticmethod
+    def _blocks(entry):
+        # Segments written before blocks were indexed are a single tail
+        return entry.get('blocks') or [[0, 0]]
+
+    def seal(self, segment):
+        """
+        Recompress the open tail of a segment as blocks of 'records_per_block' records
+        (the segment is replaced atomically, the blocks before the tail are copied as they are).
+        The index of the segment is updated but not saved.
+        """
+        entry = self.index[segment]
+        blocks = self._blocks(entry)
+        tail_offset, tail_first = blocks.pop()
+        path = self.segment_path(segment)
+        with open(path,'rb') as source, open(path + '.tmp','wb') as target:
+            remaining = tail_offset
+            while remaining:
+                chunk = source.read(min(1 << 20, remaining))
+                target.write(chunk)
+                remaining -= len(chunk)
+            with gzip.GzipFile(fileobj = source, mode = 'rb') as file:
+                lines = [line for line in file if line.strip()]
+            for first in range(0, len(lines), records_per_block):
+                blocks.append([target.tell(), tail_first + first])
+                target.write(gzip.compress(b''.join(lines[first:first + records_per_block])))
+            # New records go to a new tail
+            blocks.append([target.tell(), tail_first + len(lines)])
+        os.replace(path + '.tmp', path)
+        entry['blocks'] = blocks
+        entry['tail_parts'] = 0
+        self._unsynced.add(segment)
+
+    def sync(self):
+        """
+        Force pending appends to disk.
+        """
+        _fsync_segments(self.dir_path, self._unsynced)
+        self._appends = 0
+
+    def exists(self):
+        return bool(self.index)
+
+    def __len__(self):
+        return sum(entry['count'] for entry in self.index.values())
+
+    def __iter__(self):
+        """
+        Stream the records in the history, oldest first.
+        """
+        for _, record in self._scan():
+            yield record
+
+    def segments(self, member_id = None, start = None, end = None):
+        """
+        Segments (oldest first) that may contain records of 'member_id'
+        closed within [start, end) (numerical timestamps).
+        """
+        for segment in sorted(self.index):
+            entry = self.index[segment]
+            if member_id is not None and member_id not in entry['members']:
+                continue
+            if start is not None and entry['end'] < start:
+                continue
+            if end is not None and entry['start'] >= end:
+                continue
+            yield segment
+
+    def _scan(self, cursor = None, segments = None):
+        """
+        Stream (cursor, record) pairs starting from 'cursor', where the cursor of a record
+        points right after it: it's a '<segment>:<records to skip>' string.
+        Resuming seeks to the block holding the record, so at most a block is skipped.
+        """
+        first_segment, skip = None, 0
+        if cursor:
+            first_segment, skip = cursor.split(':')
+            skip = int(skip)
+        for segment in (self.segments() if segments is None else segments):
+            if first_segment is not None and segment < first_segment:
+                continue
+            position = skip if segment == first_segment else 0
+            blocks = self._blocks(self.index[segment])
+            offset, first = blocks[bisect.bisect_right([block[1] for block in blocks], position) - 1]
+            with open(self.segment_path(segment),'rb') as raw:
+                raw.seek(offset)
+                with gzip.GzipFile(fileobj = raw, mode = 'rb') as file:
+                    for n, line in enumerate(io.TextIOWrapper(file, encoding = 'utf-8'), start = first):
+                        if n < position:
+                            continue
+                        if line.strip():
+                            yield f'{segment}:{n + 1}', json.loads(line)
+
+    def query(self, member_id = None, counterparty = None, min_amount = None, max_amount = None,
+              event_id = None, start = None, end = None, limit = None, cursor = None):
+        """
+        Stream the records matching all the given filters, oldest first:
+            member_id: sender or receiver of the transaction
+            counterparty: the other member of the transaction (requires member_id)
+            min_amount, max_amount: inclusive bounds on the amount
+            event_id: settlement event the transaction belongs to
+            start, end: time window [start, end) of the closing time (timestamps, dates or datetimes)
+        At most 'limit' records are returned, starting after 'cursor' (see page).
+        Only the segments matching the member and time window are read.
+        """
+        filters = dict(member_id = member_id, counterparty = counterparty, min_amount = min_amount,
+                       max_amount = max_amount, event_id = event_id, start = start, end = end)
+        for _, record in self._query(filters, limit, cursor):
+            yield record
+
+    def page(self, limit, cursor = None, **filters):
+        """
+        Return up to 'limit' records matching the filters (see query) and the cursor to
+        pass to get the next page, which is None once the history is exhausted.
+        """
+        records, last_cursor = [], None
+        for position, record in self._query(filters, limit + 1, cursor):
+            if len(records) == limit:
+                return records, last_cursor
+            records.append(record)
+            last_cursor = position
+        return records, None
+
+    def _query(self, filters, limit = None, cursor = None):
+        if limit is not None and limit <= 0:
+            return
+        matches = self._record_filter(**filters)
+        start = to_timestamp_numerical(filters['start']) if filters.get('start') is not None else None
+        end = to_timestamp_numerical(filters['end']) if filters.get('end') is not None else None
+        segments = self.segments(filters.get('member_id'), start, end)
+        count = 0
+        for position, record in self._scan(cursor, segments):
+            if matches(record):
+                yield position, record
+                count += 1
+                if count == limit:
+                    return
+
+    @staticmethod
+    def _record_filter(member_id = None, counterparty = None, min_amount = None, max_amount = None,
+                       event_id = None, start = None, end = None):
+        if counterparty is not None and member_id is None:
+            raise ValueError("Filtering by counterparty requires a member_id.")
+        start = to_timestamp_numerical(start) if start is not None else None
+        end = to_timestamp_numerical(end) if end is not None else None
+        def matches(record):
+            if member_id is not None:
+                members = (record['sender'], record['receiver'])
+                if member_id not in members:
+                    return False
+                if counterparty is not None and counterparty not in members:
+                    return False
+            if min_amount is not None and record['amount'] < min_amount:
+                return False
+            if max_amount is not None and record['amount'] > max_amount:
+                return False
+            if event_id is not None and record.get('event_id') != event_id:
+                return False
+            if start is not None or end is not None:
+                time = TransactionHistory.record_time(record)
+                if start is not None and time < start:
+                    return False
+                if end is not None and time >= end:
+                    return False
+            return True
+        return matches
+
+    def migrate_from_json(self):
+        """
+        Move the records of legacy history files (a line-delimited log at 'file_path'
+        or a single JSON list next to it) to the segments.
+        """
+        migrated = False
+        legacy_jsonl = self.dir_path + '.jsonl'
+        if os.path.isfile(legacy_jsonl):
+            with open(legacy_jsonl,'r') as file:
+                records = [json.loads(line) for line in file if line.strip()]
+            migrated = self._migrate(legacy_jsonl, records)
+        legacy_json = self.dir_path + '.json'
+        if os.path.isfile(legacy_json):
+            with open(legacy_json,'r') as file:
+                records = json.load(file)
+            migrated = self._migrate(legacy_json, records) or migrated
+        return migrated
+
+    def _migrate(self, legacy_path, records):
+        self.append(records)
+        self.sync()
+        os.remove(legacy_path)
+        self.logger.info(f"Migrated {len(records)} transactions from {legacy_path} to {self.dir_path}")
+        return True
@@ -3,10 +3,14 @@ import json
 
 from backend.cls.object_with_id import ObjectWithId
 from backend.cls.saveable import Saveable
+from backend.cls.transaction_history import TransactionHistory
 from backend.utils.const import MSG
 from backend.settings import prefs
 from backend.utils.time import get_timestamp_numerical
 
+# Closed transactions are fsynced to the history once every this many closes
+history_sync_every = 20
+
 def get_transaction_info_from_id(transaction_id,path):
     if not os.path.exists(path):
         raise FileNotFoundError("Path to transactions list is not in system.")
@@ -29,6 +33,7 @@ class Transaction(ObjectWithId):
         self.receiver = receiver
         self.amount = amount
         self.time_created = time_created if time_created else get_timestamp_numerical()
+        self.time_closed = None
         self.msgs = {
             MSG.SENT : self.msg_transaction_debitor,
             MSG.RECEIVED : self.msg_transaction_creditor
@@ -48,6 +53,7 @@ class Transaction(ObjectWithId):
         self.sender.add_to_balance(self.amount)
         self.receiver.add_to_balance(-self.amount)
         self.pending = False
+        self.time_closed = get_timestamp_numerical()
     
     def POV_str(self,m_id):
         if m_id != self.sender.id and m_id != self.receiver.id:
@@ -64,6 +70,7 @@ class Transaction(ObjectWithId):
             'receiver': self.receiver.id,
             'amount': self.amount,
             'time_created': self.time_created,
+            'time_closed': self.time_closed,
             'pending': self.pending
         }
         return summary_dict
@@ -77,7 +84,7 @@ class Transaction(ObjectWithId):
 
 class PendingTransactions(Saveable):
     @Saveable.takes_class_snapshot
-    def __init__(self, owner: Saveable = None):
+    def __init__(self, owner: Saveable = None, sync_every = history_sync_every):
         super().__init__()
         self.owner = owner
         self.event_id = None
@@ -85,7 +92,9 @@ class PendingTransactions(Saveable):
                         os.path.join(prefs.data_dir,'standalone_transactions')
         prefix = f'{owner.id}_' if isinstance(owner,ObjectWithId) else '' 
         self.pending_trans_file_name = f'{prefix}pending_transactions.json'
-        self.closed_trans_file_name = f'{prefix}transactions_history.json'
+        self.closed_trans_file_name = f'{prefix}transactions_history.jsonl'
+        self.history = TransactionHistory(os.path.join(self.data_dir,self.closed_trans_file_name), 
+                                          sync_every = sync_every)
         # Dict for faster lookup
         self.pending_transactions = {}
         # List since we don't need lookups
@@ -93,29 +102,71 @@ class PendingTransactions(Saveable):
         # Used when addressing repeatable events 
         # (prevents PendingTransactions from adding copies of the same transactions)
         self.numb = False
+        # Ids of the pending transactions of each event, sender and receiver 
+        # (dicts are used as insertion-ordered sets)
+        self._event_index = {}
+        self._sender_index = {}
+        self._receiver_index = {}
         try:
             self.load()
         except FileNotFoundError as e:
             self.logger.debug(e)
             pass
     
-    def set_event_id(self, e_id: int):
+    def set_event_id(self, e_id):
         self.event_id = e_id
-        self.numb = False
-        for t in self.pending_transactions.values():
-            if t.event_id == e_id:
-                self.logger.warning(f"Event {e_id} is being repeated. Adding transactions through this event will be ignored!")
-                self.numb = True
-                return
+        self.numb = e_id in self._event_index
+        if self.numb:
+            self.logger.warning(f"Event {e_id} is being repeated. Adding transactions through this event will be ignored!")
+
+    def event_transactions(self, e_id):
+        return [self.pending_transactions[t_id] for t_id in self._event_index.get(e_id, ())]
+
+    def sent_transactions(self, member_id):
+        return [self.pending_transactions[t_id] for t_id in self._sender_index.get(member_id, ())]
+
+    def received_transactions(self, member_id):
+        return [self.pending_transactions[t_id] for t_id in self._receiver_index.get(member_id, ())]
+
+    def _index_transaction(self, transaction: Transaction):
+        for index, key in self._index_keys(transaction):
+            if key is not None:
+                index.setdefault(key, {})[transaction.id] = None
+
+    def _unindex_transaction(self, transaction: Transaction):
+        for index, key in self._index_keys(transaction):
+            ids = index.get(key)
+            if ids is not None:
+                ids.pop(transaction.id, None)
+                if not ids:
+                    del index[key]
+
+    def _index_keys(self, transaction: Transaction):
+        return ((self._event_index, transaction.event_id),
+                (self._sender_index, transaction.sender.id),
+                (self._receiver_index, transaction.receiver.id))
+
+    def _rebuild_indexes(self):
+        self._event_index = {}
+        self._sender_index = {}
+        self._receiver_index = {}
+        for transaction in self.pending_transactions.values():
+            self._index_transaction(transaction)
+
+    def _restore_state(self, changes, undo):
+        super()._restore_state(changes, undo)
+        self._rebuild_indexes()
     
     def member_transactions(self,member_id, event_id = False):
+        """
+        Pending transactions sent or received by the member (only the ones 
+        of the current event if 'event_id' is True).
+        """
+        transactions = self.sent_transactions(member_id) + \
+                       [t for t in self.received_transactions(member_id) if t.sender.id != member_id]
         if event_id:
-            return [t for t in self.pending_transactions.values() \
-                if (t.sender.id == member_id or t.receiver.id == member_id) \
-                and t.event_id == self.event_id]
-        
-        return [t for t in self.pending_transactions.values() \
-                if t.sender.id == member_id or t.receiver.id == member_id]
+            return [t for t in transactions if t.event_id == self.event_id]
+        return transactions
     
     def pending_transactions_summary(self):
         return [t.summary() for t in self.pending_transactions.values()]
@@ -125,8 +176,19 @@ class PendingTransactions(Saveable):
 
     @Saveable.affects_metadata(log_msg="Added transaction to pending transactions")
     def add_transaction(self,transaction: Transaction):
+        self._add_transaction(transaction)
+
+    @Saveable.affects_metadata(log_msg="Added transactions to pending transactions")
+    def add_transactions(self, transactions):
+        """
+        Add a whole batch of transactions, taking a single snapshot and saving once.
+        """
+        for transaction in transactions:
+            self._add_transaction(transaction)
+
+    def _add_transaction(self,transaction: Transaction):
         if self.numb:
-            self.logger.debug(f"Ignoring transaction {transaction.id}")
+            self.logger.debug("Ignoring transaction %s", transaction.id)
             return
         if transaction.id in self.pending_transactions:
             if self.pending_transactions[transaction.id] == transaction:
@@ -141,18 +203,65 @@ class PendingTransactions(Saveable):
             transaction.event_id = self.event_id
         
         self.pending_transactions[transaction.id] = transaction
+        self._index_transaction(transaction)
     
     @Saveable.affects_metadata(log_msg="Closed transaction")
     def close_transaction(self, transaction_id: str):
+        self._close_transaction(transaction_id)
+
+    @Saveable.affects_metadata(log_msg="Closed transactions")
+    def close_transactions(self, transaction_ids):
+        for transaction_id in transaction_ids:
+            self._close_transaction(transaction_id)
+
+    def _close_transaction(self, transaction_id: str):
         if not transaction_id in self.pending_transactions:
             self.logger.warning(f"Transaction {transaction_id} not in PendingTransactions {self.id}")
         transaction = self.pending_transactions.pop(transaction_id)
+        self._unindex_transaction(transaction)
         transaction.close()
         self.closed_transactions.append(transaction)
     
-    def close_all(self):
-        for trans in self.pending_transactions:
-            self.close_transaction(trans)
+    @Saveable.affects_metadata(log_msg="Amended transaction")
+    def amend_transaction(self, transaction_id: str, amount):
+        """
+        Change the amount of a pending transaction (the transaction is replaced 
+        by an updated copy, so that the change is recorded for undo/redo).
+        """
+        old = self.pending_transactions[transaction_id]
+        self.pending_transactions[transaction_id] = Transaction(sender = old.sender,
+                                                                receiver = old.receiver,
+                                                                amount = amount,
+                                                                time_created = old.time_created,
+                                                                id = old.id,
+                                                                event_id = old.event_id)
+
+    @Saveable.affects_metadata(log_msg="Cancelled transaction")
+    def cancel_transaction(self, transaction_id: str):
+        """
+        Drop a pending transaction that is no longer needed, it doesn't go to the history.
+        """
+        self._unindex_transaction(self.pending_transactions.pop(transaction_id))
+
+    def close_all(self, member_id = None, event_id = None):
+        """
+        Close all the pending transactions, or only the ones of a member and/or of an event.
+        Balances, history and pending transactions are all saved once at the end.
+        Returns the closed transactions.
+        """
+        if event_id is not None:
+            transactions = self.event_transactions(event_id)
+            if member_id is not None:
+                transactions = [t for t in transactions if member_id in (t.sender.id, t.receiver.id)]
+        elif member_id is not None:
+            transactions = self.member_transactions(member_id)
+        else:
+            transactions = list(self.pending_transactions.values())
+        if not transactions:
+            return []
+        with Saveable.batch():
+            self.close_transactions([t.id for t in transactions])
+        return transactions
 
     def save_data(self):
         if not os.path.exists(self.data_dir):
@@ -163,17 +272,9 @@ class PendingTransactions(Saveable):
             json.dump(dict_to_save,file, indent=4)
         
         if len(self.closed_transactions):
-            c_t_file = os.path.join(self.data_dir,self.closed_trans_file_name)
-            transaction_history = []
-            if os.isfile(c_t_file):
-                with open(c_t_file,'r') as file:
-                    transaction_history = json.load(file)
-
-            transaction_history.extend(self.closed_transactions_summary())
-            with open(c_t_file,'w+') as file:
-                json.dump(transaction_history,file)
-                # Clear the closed transactions
-                self.closed_transactions = {}
+            # Only the newly closed transactions are written to the history
+            self.history.append(self.closed_transactions_summary())
+            self.closed_transactions = []
 
     def transaction_history(self):
         """
@@ -181,13 +282,10 @@ class PendingTransactions(Saveable):
         of this group/list. Mainly for UX, but with the frontend
         will not be used.
         """  
-        c_t_file = os.path.join(self.data_dir,self.closed_trans_file_name)
-        if not os.path.isfile(c_t_file):
+        if not self.history.exists():
             self.logger.warning("Transaction history file not found.")
             return
-        with open(c_t_file,'r') as file:
-            transaction_history = json.load(file)
-        for transaction in transaction_history:
+        for transaction in self.history:
             print(transaction)
 
 
@@ -199,15 +297,20 @@ class PendingTransactions(Saveable):
         with open(p_t_file,'r') as file:
             transactions = json.load(file)
         for t in transactions:
-            if self.owner and (not t['sender'] in self.owner.members or not t['receiver'] in self.owner.members):
+            if self.owner and (not t['sender'] in self.owner.members.members_by_id or 
+                               not t['receiver'] in self.owner.members.members_by_id):
                 raise ValueError("Members involved in transaction "
-                                 f"{t['sender']} and t['receiver'] are "
+                                 f"{t['sender']} and {t['receiver']} are "
                                  "not related to these PendingTransactions for "
                                  f"{type(self.owner).__name__} {self.owner.id}")
             if not t['pending']:
                 raise ValueError("Transaction found in file is closed, closed transactions cannot be loaded")
-            sender = Member(t['sender'])
-            receiver = Member(t['receiver'])
+            if self.owner:
+                sender = self.owner.members.get_by_id(t['sender'])
+                receiver = self.owner.members.get_by_id(t['receiver'])
+            else:
+                sender = Member(id = t['sender'])
+                receiver = Member(id = t['receiver'])
             new_trans = Transaction(sender = sender,
                                     receiver = receiver,
                                     amount = t['amount'],
@@ -215,6 +318,7 @@ class PendingTransactions(Saveable):
                                     id = t['id'],
                                     event_id = t['event_id'])
             self.pending_transactions[new_trans.id] = new_trans
+            self._index_transaction(new_trans)
             
 
 
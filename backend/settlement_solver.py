@@ -0,0 +1,224 @@
+"""
+Settlement plans computed on integer cents. Balances are given as a vector
+(positive for creditors, negative for debitors) and plans are returned as
+lists of (debitor index, creditor index, amount in cents) transfers.
+"""
+import hashlib
+import heapq
+import time
+import numpy as np
+
+from backend.utils.const import ItemPrintEnum
+
+# Above this number of (non settled) members the exact solver is not used
+EXACT_MAX_MEMBERS = 16
+# Default time (in seconds) spent looking for zero-sum subgroups in large groups
+DEFAULT_TIME_BUDGET = 0.5
+# Kinds of adjustment made to a pending plan (see incremental_adjustments)
+ADD = 'add'
+AMEND = 'amend'
+CANCEL = 'cancel'
+
+class SettleMode(ItemPrintEnum):
+    # Legacy pass over members sorted by balance
+    GREEDY = 0
+    # Minimise the number of transfers (exact for small groups)
+    MIN_TRANSFERS = 1
+    # Heap-based matching of the largest debitor and creditor, for large groups
+    FAST = 2
+
+def to_cents(balances):
+    """
+    Convert balances to integer cents, moving the rounding residual (if any)
+    to the member with the largest balance so that the result sums to zero.
+    """
+    cents = np.rint(np.asarray(balances, dtype = float)*100).astype(np.int64)
+    residual = int(cents.sum())
+    if residual and len(cents):
+        cents[int(np.argmax(np.abs(cents)))] -= residual
+    return cents
+
+def fingerprint(cents_by_member):
+    """
+    Stable id of a settlement event: hash of the sorted (member id, balance in cents) pairs.
+    """
+    digest = hashlib.blake2b(digest_size = 8)
+    for m_id, cents in sorted(cents_by_member.items()):
+        digest.update(f'{m_id}:{int(cents)};'.encode())
+    return digest.hexdigest()
+
+def greedy_transfers(cents, members = None):
+    """
+    Match the largest debitor with the largest creditor until everyone is settled,
+    using two priority queues. O(n log n), at most n-1 transfers.
+    'members' restricts the plan to the given indices.
+    """
+    members = range(len(cents)) if members is None else members
+    creditors = [(-int(cents[i]), i) for i in members if cents[i] > 0]
+    debitors = [(int(cents[i]), i) for i in members if cents[i] < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debitors)
+    transfers = []
+    while creditors and debitors:
+        credit, c = heapq.heappop(creditors)
+        debt, d = heapq.heappop(debitors)
+        amount = min(-credit, -debt)
+        transfers.append((d, c, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, c))
+        if -debt > amount:
+            heapq.heappush(debitors, (debt + amount, d))
+    return transfers
+
+def exact_min_transfers(cents):
+    """
+    Plan with the minimum number of transfers: the members are partitioned in as many
+    zero-sum subgroups as possible (bitmask dynamic programming over all the subsets,
+    O(2^n n)), then each subgroup of k members is settled with k-1 transfers.
+    """
+    members = [i for i in range(len(cents)) if cents[i] != 0]
+    n = len(members)
+    if n == 0:
+        return []
+    values = np.array([cents[i] for i in members], dtype = np.int64)
+    masks = np.arange(1 << n, dtype = np.int64)
+    # Sum of the balances of each subset
+    sums = np.zeros(1 << n, dtype = np.int64)
+    for bit in range(n):
+        sums[masks & (1 << bit) != 0] += values[bit]
+    zero_sum = (sums == 0).astype(np.int64)
+    # best[mask]: max number of zero-sum subgroups the members of 'mask' can be split in
+    best = np.zeros(1 << n, dtype = np.int64)
+    popcount = np.zeros(1 << n, dtype = np.int64)
+    for bit in range(n):
+        popcount += (masks >> bit) & 1
+    for size in range(1, n + 1):
+        layer = masks[popcount == size]
+        layer_best = np.zeros(len(layer), dtype = np.int64)
+        for bit in range(n):
+            has_bit = (layer >> bit) & 1 == 1
+            candidates = best[layer[has_bit] ^ (1 << bit)]
+            layer_best[has_bit] = np.maximum(layer_best[has_bit], candidates)
+        best[layer] = layer_best + zero_sum[layer]
+
+    # Remove members one at a time following the optimal choices, a subgroup
+    # is closed every time the remaining members sum up to zero
+    groups, group = [], []
+    mask = (1 << n) - 1
+    while mask:
+        for bit in range(n):
+            if mask & (1 << bit) and best[mask ^ (1 << bit)] + zero_sum[mask] == best[mask]:
+                break
+        if zero_sum[mask] and group:
+            groups.append(group)
+            group = []
+        group.append(members[bit])
+        mask ^= 1 << bit
+    groups.append(group)
+
+    transfers = []
+    for group in groups:
+        transfers.extend(greedy_transfers(cents, group))
+    return transfers
+
+def _match_subgroups(cents, deadline):
+    """
+    Settle pairs (and, while time is left, triples) of members whose balances cancel
+    out with a single transfer (two transfers for triples). Returns the transfers
+    and the indices of the members left to settle.
+    """
+    transfers = []
+    open_creditors = {}
+    for i in np.flatnonzero(cents > 0):
+        open_creditors.setdefault(int(cents[i]), []).append(int(i))
+    remaining_debitors = []
+    for d in np.flatnonzero(cents < 0):
+        d = int(d)
+        matches = open_creditors.get(int(-cents[d]))
+        if matches:
+            transfers.append((d, matches.pop(), int(-cents[d])))
+        else:
+            remaining_debitors.append(d)
+    remaining_creditors = [c for matches in open_creditors.values() for c in matches]
+
+    # Two debitors paying the same creditor
+    by_credit = {}
+    for c in remaining_creditors:
+        by_credit.setdefault(int(cents[c]), []).append(c)
+    settled = set()
+    for k, d1 in enumerate(remaining_debitors):
+        if time.perf_counter() > deadline:
+            break
+        if d1 in settled:
+            continue
+        for d2 in remaining_debitors[k + 1:]:
+            if d2 in settled:
+                continue
+            matches = by_credit.get(int(-(cents[d1] + cents[d2])))
+            if matches:
+                c = matches.pop()
+                transfers.append((d1, c, int(-cents[d1])))
+                transfers.append((d2, c, int(-cents[d2])))
+                settled.update((d1, d2, c))
+                break
+    left = [i for i in remaining_debitors + remaining_creditors if i not in settled]
+    return transfers, left
+
+def min_transfers(cents, time_budget = DEFAULT_TIME_BUDGET, exact_max_members = EXACT_MAX_MEMBERS):
+    """
+    Plan minimising the number of transfers. Small groups are solved exactly,
+    larger groups first settle the zero-sum pairs and triples that can be found
+    within 'time_budget' seconds, then fall back to the heap-based greedy.
+    """
+    cents = np.asarray(cents, dtype = np.int64)
+    if np.count_nonzero(cents) <= exact_max_members:
+        return exact_min_transfers(cents)
+    deadline = time.perf_counter() + (time_budget if time_budget is not None else float('inf'))
+    transfers, left = _match_subgroups(cents, deadline)
+    transfers.extend(greedy_transfers(cents, left))
+    return transfers
+
+def plan_transfers(cents, mode = SettleMode.FAST, time_budget = DEFAULT_TIME_BUDGET):
+    """
+    Plan for the given mode. The legacy GREEDY mode only exists in BalanceSettler,
+    here it's served by the heap-based greedy.
+    """
+    if mode == SettleMode.MIN_TRANSFERS:
+        return min_transfers(cents, time_budget)
+    return greedy_transfers(cents)
+
+def incremental_adjustments(plan, deltas):
+    """
+    Adjust a settlement plan to changed balances, only looking at the members whose
+    balance changed. 'plan' maps (debitor id, creditor id) to the pending amount in cents
+    (at least the transfers between changed members), 'deltas' maps the ids of the changed 
+    members to the change of their balance in cents (summing up to zero).
+    The deltas are settled among the changed members and netted against the existing
+    transfers. Returns a list of (kind, debitor id, creditor id, new amount) adjustments,
+    kind being one of ADD, AMEND or CANCEL.
+    """
+    ids = list(deltas)
+    cents = np.array([deltas[m_id] for m_id in ids], dtype = np.int64)
+    amounts = {}
+    current = lambda pair: amounts.get(pair, plan.get(pair, 0))
+    for d, c, amount in greedy_transfers(cents):
+        d_id, c_id = ids[d], ids[c]
+        # Paying back a transfer that goes the other way reduces it instead
+        reverse = current((c_id, d_id))
+        if reverse:
+            netted = min(reverse, amount)
+            amounts[(c_id, d_id)] = reverse - netted
+            amount -= netted
+        if amount:
+            amounts[(d_id, c_id)] = current((d_id, c_id)) + amount
+
+    adjustments = []
+    for (d_id, c_id), amount in amounts.items():
+        if (d_id, c_id) not in plan:
+            if amount:
+                adjustments.append((ADD, d_id, c_id, amount))
+        elif amount == 0:
+            adjustments.append((CANCEL, d_id, c_id, 0))
+        elif amount != plan[(d_id, c_id)]:
+            adjustments.append((AMEND, d_id, c_id, amount))
+    return adjustments
@@ -4,7 +4,7 @@ class Singleton:
     logger = get_logger("Singleton")
     def __new__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            Singleton.logger.debug(f"Instance of {cls} was not there, creating one.")
+            Singleton.logger.debug("Instance of %s was not there, creating one.", cls)
             # First get the instance from default python, then handle it.
             instance = super().__new__(cls)
             instance.__init__(*args, **kwargs)
@@ -0,0 +1,37 @@
+from backend.balance_calculator import BalanceCalculator
+from backend.tests.test_lists import init_basic_list
+import numpy as np
+
+def init_calculator():
+    l = init_basic_list()
+    a, b = l.members.get_by_name('A'), l.members.get_by_name('B')
+    a.spent_total, a.days_spent = 30, 10
+    b.spent_total, b.days_spent = 0, 5
+    return BalanceCalculator(l), a, b
+
+def test_calculate_balances():
+    calc, a, b = init_calculator()
+    balances = calc.calculate_balances()
+    assert balances == [10, -10]
+    assert (a.balance, b.balance) == (10, -10)
+
+def test_balances_follow_member_data():
+    calc, a, b = init_calculator()
+    calc.calculate_balances()
+    b.spent_total = 30
+    a.days_spent = 5
+    assert calc.calculate_balances() == [0, 0]
+
+def test_calculate_cycles():
+    calc, a, b = init_calculator()
+    spent = np.array([[30, 0], [0, 20]])
+    days = np.array([[10, 5], [5, 5]])
+    cycles = calc.calculate_cycles(spent, days, write_back = True)
+    assert np.allclose(cycles, [[10, -10], [-10, 10]])
+    assert abs(a.balance) < 1e-9
+
+
+if __name__ == '__main__':
+    test_calculate_balances()
+    test_balances_follow_member_data()
+    test_calculate_cycles()
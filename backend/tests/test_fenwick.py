@@ -0,0 +1,26 @@
+from backend.utils.fenwick import FenwickTree, TemporalIndex
+from datetime import date
+import numpy as np
+
+def test_fenwick_tree():
+    values = np.arange(20, dtype = float).reshape(10, 2)
+    tree = FenwickTree.from_array(values)
+    assert np.allclose(tree.range(3, 7), values[2:7].sum(axis = 0))
+    tree.add(4, [1], [5])
+    values[3, 1] += 5
+    assert np.allclose(tree.prefix(10), values.sum(axis = 0))
+    assert np.allclose(tree.to_array(), values)
+
+def test_temporal_index_grows():
+    index = TemporalIndex()
+    index.add(date(2024, 3, 10), {'balance': {'mm0001': 10, 'mm0002': -10}})
+    index.add(date(2023, 1, 1), {'balance': {'mm0003': 5, 'mm0001': -5}})
+    index.add(date(2026, 1, 1), {'balance': {'mm0002': 1}})
+    assert index.query('balance') == {'mm0001': 5, 'mm0002': -9, 'mm0003': 5}
+    assert index.query('balance', '2024-01-01', '2024-12-31') == {'mm0001': 10, 'mm0002': -10, 'mm0003': 0}
+    assert index.query('balance', end = '2023-06-01')['mm0001'] == -5
+
+
+if __name__ == '__main__':
+    test_fenwick_tree()
+    test_temporal_index_grows()
@@ -1,5 +1,6 @@
-import os, sys
+import os, sys, json
 from backend.cls.group import Group
+from backend.cls.list import List, ListItem
 from backend.cls.member import Member
 from backend.utils.logging import Logger, LogLevel
 from backend.tests.test_lists import init_basic_list
@@ -29,7 +30,55 @@ def test_add_list():
         ls2.add_member(Member('C'))
         group.add_list(ls2)
 
+def test_group_load_lazy_lists():
+    group = init_basic_group()
+    for k in range(3):
+        ls = List(f"list_{k}", [m for m in group.members])
+        group.add_list(ls)
+    group.save_data()
+    path = os.path.join(group.data_dir, group.file_name)
+    loaded = Group(load_from_file = True, load_file_path = path, max_loaded_lists = 2)
+    assert loaded.id == group.id
+    assert len(loaded.lists) == 3
+    assert not any(l.is_loaded() for l in loaded.lists.values())
+    assert sorted(l.name for l in loaded.lists.values()) == ["list_0", "list_1", "list_2"]
+    for l in loaded.lists.values():
+        assert len(l.members) == 2
+    assert sum(l.is_loaded() for l in loaded.lists.values()) == 2
+
+def test_group_balances():
+    group = init_basic_group()
+    ls = List("expenses", [m for m in group.members])
+    group.add_list(ls)
+    a = ls.members.get_by_name('A')
+    item = ListItem('test_i', a, amount = 10, members_involved = ls.members)
+    ls.add_item(item)
+    assert group.balances() == {a.id: 5, ls.members.get_by_name('B').id: -5}
+    assert group.spent_totals()[a.id] == 10
+    path = os.path.join(group.data_dir, group.file_name)
+    loaded = Group(load_from_file = True, load_file_path = path)
+    assert loaded.balances() == group.balances()
+    assert not any(l.is_loaded() for l in loaded.lists.values())
+    ls.remove_item(item.id)
+    assert all(abs(b) < 1e-9 for b in group.balances().values())
+
+def test_group_balances_follow_list_undo():
+    group = init_basic_group()
+    ls = List("expenses", [m for m in group.members])
+    group.add_list(ls)
+    a, b = ls.members.get_by_name('A'), ls.members.get_by_name('B')
+    ls.add_item(ListItem('test_i', a, amount = 10, members_involved = ls.members))
+    assert group.balances() == {a.id: 5, b.id: -5}
+    ls.undo()
+    assert len(ls.items) == 0
+    assert all(abs(v) < 1e-9 for v in group.balances().values())
+    with open(os.path.join(group.data_dir, group.balances_file_name)) as file:
+        assert all(abs(entry['balance']) < 1e-9 for entry in json.load(file).values())
+    ls.redo()
+    assert group.balances() == {a.id: 5, b.id: -5}
+
 
 if __name__ == '__main__':
     test_group_init()
-    test_add_list()
\ No newline at end of file
+    test_add_list()
+    test_group_load_lazy_lists()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from backend.cls.list import List, ListItem
+from backend.cls.list import List, ListItem, SharingMethods
 from backend.cls.member import Member
 from backend.utils.logging import Logger, LogLevel
 import os
@@ -26,6 +26,17 @@ def test_list_load():
     l2 = List(load_from_file=True,load_file_path=os.path.join(dir,file_name))
     assert len(l2.members) == 2
 
+def test_list_load_items():
+    l = init_basic_list()
+    a = l.members.get_by_name('A')
+    l.add_item(ListItem('test_i',a,amount = 10,members_involved=l.members))
+    balance = a.balance
+    l2 = List(load_from_file=True,load_file_path=os.path.join(l.data_dir,l.file_name))
+    assert len(l2.items) == 1
+    item = list(l2.items.values())[0]
+    assert item.amount == 10
+    assert l2.members.get_by_name('A').balance == balance
+
 def test_list_undo_redo():
     Logger.set_log_level(LogLevel.DEBUG)
     l = init_basic_list()
@@ -37,6 +48,114 @@ def test_list_undo_redo():
     l.redo()
     assert len(l.members) == 3
 
+def test_undo_records_only_changes():
+    l = init_basic_list()
+    a = l.members.get_by_name('A')
+    for k in range(20):
+        l.add_item(ListItem(f'item_{k}',a,amount = 2,members_involved=l.members))
+    changes = l._version_history[-1].changes
+    assert list(changes) == ['items']
+    assert len(changes['items']) == 1
+    l.undo()
+    assert len(l.items) == 19
+    l.redo()
+    assert len(l.items) == 20
+
+def test_undo_item_edit():
+    l = init_basic_list()
+    a = l.members.get_by_name('A')
+    l.add_item(ListItem('edited',a,amount = 10,members_involved=l.members))
+    item_id = next(iter(l.items))
+    versions = len(l._version_history)
+    l.save_version()
+    assert len(l._version_history) == versions
+    l.edit_item(item_id,'amount',20)
+    assert l.items[item_id].amount == 20
+    l.undo()
+    assert l.items[item_id].amount == 10
+    l.redo()
+    assert l.items[item_id].amount == 20
+
+def test_list_ledger():
+    l = init_basic_list()
+    a = l.members.get_by_name('A')
+    l.add_item(ListItem('test_i',a,amount = 10,members_involved=l.members))
+    assert abs(l.credits - (a.balance if a.balance > 0 else 0)) < 1e-9
+    assert abs(l.credits + l.debits) < 1e-9
+    assert l.verify()
+    a.add_to_balance(5)
+    with pytest.raises(ValueError):
+        l.verify()
+    a.add_to_balance(-5)
+
+def test_list_add_items(monkeypatch):
+    l = init_basic_list()
+    a, b = l.members.get_by_name('A'), l.members.get_by_name('B')
+    start = (a.balance, b.balance)
+    saves = []
+    monkeypatch.setattr(Member, 'save_data', lambda self: saves.append(self.name))
+    items = [{'name': f'item_{k}', 'bought_by': 'A', 'amount': 4} for k in range(100)]
+    items.append({'name': 'single', 'bought_by': b, 'amount': 3, 'members_involved': [a.id]})
+    l.add_items(items)
+    assert len(l.items) == 101
+    assert abs(a.balance - start[0] - 197) < 1e-9
+    assert abs(b.balance - start[1] + 197) < 1e-9
+    assert sorted(saves) == ['A', 'B']
+    with pytest.raises(ValueError):
+        l.add_items([{'name': 'bad', 'bought_by': 'Nobody', 'amount': 1}])
+    assert len(l.items) == 101
+
+def test_list_items_keep_their_members():
+    l = init_basic_list()
+    a, b = l.members.get_by_name('A'), l.members.get_by_name('B')
+    start = (a.balance, b.balance)
+    l.add_items([{'name': 'given', 'bought_by': 'A', 'amount': 10, 'shares': {a.id: 7, b.id: 3}}])
+    assert abs(a.balance - start[0] - 3) < 1e-9
+    assert abs(b.balance - start[1] + 3) < 1e-9
+    for shares in ({a.id: 1, b.id: 1}, {b.id: 10}):
+        with pytest.raises(ValueError):
+            l.add_items([{'name': 'bad', 'bought_by': 'A', 'amount': 10, 'shares': shares}])
+    assert len(l.items) == 1
+    assert abs(a.balance - start[0] - 3) < 1e-9
+    l.add_item({'name': 'shared', 'bought_by': 'A', 'amount': 10})
+    item = next(i for i in l.items.values() if i.name == 'shared')
+    l.add_member(Member('C'))
+    assert len(item.members_involved) == 2
+    assert len(item.balance_deltas()) == 2
+    l.save_data()
+
+def test_weighted_shares():
+    l = init_basic_list()
+    a, b = l.members.get_by_name('A'), l.members.get_by_name('B')
+    a.set_sharing_weight('rooms', 3)
+    b.set_sharing_weight('rooms', 1)
+    i = ListItem('rent',a,amount = 100,members_involved=l.members,
+                 sharing_method=SharingMethods.WEIGHTED,sharing_weight_name='rooms')
+    assert i.shares == {a.id: 75, b.id: 25}
+    cached = l.members.weight_vector('rooms')
+    assert l.members.weight_vector('rooms') is cached
+    b.sharing_weights['rooms'].value = 3
+    assert l.members.weight_vector('rooms') is not cached
+    i2 = ListItem('rent',a,amount = 100,members_involved=l.members,
+                  sharing_method=SharingMethods.WEIGHTED,sharing_weight_name='rooms')
+    assert i2.shares == {a.id: 50, b.id: 50}
+    # Items added as dicts use the vectors of the list, without watching the weights themselves
+    watchers = len(a._weight_watchers)
+    l.add_items([{'name': f'rent_{k}', 'bought_by': 'A', 'amount': 60,
+                  'sharing_method': SharingMethods.WEIGHTED, 'sharing_weight_name': 'rooms'} for k in range(20)])
+    assert len(a._weight_watchers) == watchers
+    assert all(item.shares == {a.id: 30, b.id: 30} for item in l.items.values() if item.name.startswith('rent_'))
+
+def test_list_time_range_queries():
+    l = init_basic_list()
+    a, b = l.members.get_by_name('A'), l.members.get_by_name('B')
+    l.add_item(ListItem('jan',a,amount = 10,members_involved=l.members,time_created='20240110_120000_000000'))
+    l.add_item(ListItem('feb',b,amount = 20,members_involved=l.members,time_created='20240210_120000_000000'))
+    assert l.balances_between('2024-01-01','2024-01-31') == {a.id: 5, b.id: -5}
+    l.add_item(ListItem('feb2',a,amount = 4,members_involved=l.members,time_created='20240215_120000_000000'))
+    assert l.spent_between('2024-02-01','2024-02-29') == {a.id: 4, b.id: 20}
+    assert l.balances_between() == {a.id: -3, b.id: 3}
+
 
 if __name__ == '__main__':
     test_list_init()
@@ -0,0 +1,40 @@
+from backend.utils.logging import Logger, LogLevel, LogSink, get_logger
+import io
+
+def test_lazy_messages(monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(Logger, 'sink', LogSink(stream))
+    monkeypatch.setattr(Logger, 'level', LogLevel.WARNING)
+    logger = get_logger('Test')
+    calls = []
+    logger.debug(lambda: calls.append(True) or 'expensive')
+    logger.debug("%s", object())
+    assert calls == [] and stream.getvalue() == ''
+    assert not logger.is_enabled_for(LogLevel.INFO) and logger.is_enabled_for(LogLevel.ERROR)
+    logger.warning("%d items in %s", 3, 'list')
+    logger.error(lambda: 'computed')
+    assert stream.getvalue() == "WARNING\tTest: 3 items in list\nERROR\tTest: computed\n"
+
+def test_log_level_ordering():
+    assert LogLevel.DEBUG <= LogLevel.WARNING and LogLevel.DEBUG < LogLevel.WARNING
+    assert LogLevel.ERROR > LogLevel.WARNING and not LogLevel.ERROR <= LogLevel.WARNING
+    assert LogLevel.DEBUG != 1
+
+def test_buffered_sink():
+    stream = io.StringIO()
+    sink = LogSink(stream, flush_interval = 60, buffer_size = 3)
+    sink.write('a\n', LogLevel.WARNING)
+    sink.write('b\n', LogLevel.WARNING)
+    assert stream.getvalue() == ''
+    sink.write('c\n', LogLevel.WARNING)
+    assert stream.getvalue() == 'a\nb\nc\n'
+    sink.write('d\n', LogLevel.WARNING)
+    sink.write('e\n', LogLevel.ERROR)
+    assert stream.getvalue().endswith('d\ne\n')
+    sink.write('f\n', LogLevel.INFO)
+    sink.close()
+    assert stream.getvalue().endswith('f\n')
+    background = LogSink(stream, flush_interval = 0.01, background = True)
+    background.write('g\n', LogLevel.INFO)
+    background.close()
+    assert stream.getvalue().endswith('g\n')
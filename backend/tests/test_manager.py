@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from backend.cls.manager import ProfileManager
+from backend.cls.list import List, ListItem
+from backend.settlement_solver import SettleMode
+from backend.tests.test_groups import init_basic_group
+
+def init_settleable_group(amount):
+    group = init_basic_group()
+    ls = List("expenses", [m for m in group.members])
+    group.add_list(ls)
+    a = ls.members.get_by_name('A')
+    ls.add_item(ListItem('test_i', a, amount = amount, members_involved = ls.members))
+    return group
+
+def test_settle_balances():
+    groups = [init_settleable_group(10), init_settleable_group(30)]
+    manager = ProfileManager(None)
+    manager.user_groups = {g.id: g for g in groups}
+    report = manager.settle_balances([g.id for g in groups], mode = SettleMode.MIN_TRANSFERS, max_workers = 2)
+    assert set(report['groups']) == set(manager.user_groups)
+    assert report['members_per_second'] > 0
+    for group in groups:
+        pending = list(manager.pending[group.id].pending_transactions.values())
+        assert len(pending) == 1
+        assert pending[0].sender.name == 'B'
+        assert pending[0].amount == group.balances()[pending[0].receiver.id]
+    # The same balances are not settled twice
+    report = manager.settle_balances(groups[0].id)
+    assert not report['groups'][groups[0].id]['committed']
+    assert len(manager.pending[groups[0].id].pending_transactions) == 1
+    manager.close()
+
+def test_settle_after_closing():
+    group = init_settleable_group(10)
+    manager = ProfileManager(None)
+    manager.user_groups = {group.id: group}
+    manager.settle_balances(group.id)
+    manager.pending[group.id].close_all()
+    assert all(abs(m.balance) < 1e-9 for m in group.members)
+    report = manager.settle_balances(group.id)
+    assert not report['groups'][group.id]['committed']
+    assert len(manager.pending[group.id].pending_transactions) == 0
+
+def test_settle_reuses_executor():
+    groups = [init_settleable_group(10), init_settleable_group(30)]
+    manager = ProfileManager(None)
+    manager.user_groups = {g.id: g for g in groups}
+    manager.settle_balances(list(manager.user_groups), max_workers = 2)
+    executor = manager._executor
+    manager.settle_balances(list(manager.user_groups), max_workers = 2)
+    assert manager._executor is executor
+    manager.close()
+    assert manager._executor is None
+    # A given executor is used and left running
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        report = manager.settle_balances(list(manager.user_groups), executor = executor)
+        assert len(report['groups']) == 2
+        assert executor.submit(len, 'ok').result() == 2
+    assert manager._executor is None
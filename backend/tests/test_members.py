@@ -0,0 +1,114 @@
+from backend.cls.member import Member, MembersList
+from backend.cls.member_store import MemberStore, default_members_file
+from backend.cls.saveable import Saveable
+import os, json
+import pytest
+
+def test_member_store_lookups(tmp_path):
+    store = MemberStore(str(tmp_path))
+    store.save({'id': 'mm9990', 'name': 'X', 'user_id': None, 'time_created': None, 'involved_in': ['ls0001']})
+    assert store.members_from_id('mm9990')['name'] == 'X'
+    assert store.members_from_name('X')['involved_in'] == ['ls0001']
+    assert store.members_from_name('Y') is None
+    # Updates are done in place
+    store.save({'id': 'mm9990', 'name': 'X', 'user_id': None, 'time_created': None, 'involved_in': []})
+    assert len(store) == 1
+    with pytest.raises(Exception):
+        store.save({'id': 'mm9990', 'name': 'Z'})
+
+def test_member_store_migration(tmp_path):
+    m_dict = {'id': 'mm9991', 'name': 'W', 'user_id': None, 'time_created': None, 'involved_in': []}
+    with open(os.path.join(tmp_path, default_members_file),'w') as file:
+        json.dump({'members_from_id': {'mm9991': m_dict}, 'members_from_name': {'W': m_dict}}, file)
+    store = MemberStore(str(tmp_path))
+    assert store.members_from_name('W')['id'] == 'mm9991'
+    assert not os.path.exists(os.path.join(tmp_path, default_members_file))
+
+def test_member_load():
+    m = Member('A')
+    m2 = Member('A')
+    assert m.id == m2.id
+    assert Member(id = m.id).name == 'A'
+
+def test_members_list_iteration_and_status():
+    a, b = Member('A'), Member('B')
+    members = MembersList(members = [a, b])
+    assert [(m1.name, m2.name) for m1 in members for m2 in members] == \
+           [('A','A'), ('A','B'), ('B','A'), ('B','B')]
+    # Balances are only watched once the status buckets are used
+    assert members not in a._balance_watchers
+    members.creditors
+    assert members in a._balance_watchers
+    balance_a, balance_b = a.balance, b.balance
+    try:
+        a.add_to_balance(10 - a.balance)
+        b.add_to_balance(-10 - b.balance)
+        assert members.creditors == [a] and members.debitors == [b]
+        b.add_to_balance(10)
+        assert members.debitors == [] and members.settled_up == [b]
+        members.remove_member(a)
+        assert members.creditors == []
+    finally:
+        a.add_to_balance(balance_a - a.balance)
+        b.add_to_balance(balance_b - b.balance)
+
+def test_batch_saves_once(monkeypatch):
+    m = Member('A')
+    saves = []
+    monkeypatch.setattr(m, 'save_data', lambda: saves.append(m.balance))
+    n_versions = len(m._version_history)
+    with m.batch():
+        for _ in range(5):
+            m.add_to_balance(1)
+        assert saves == []
+    assert saves == [m.balance]
+    assert len(m._version_history) == n_versions + 1
+
+def test_failed_batch_saves_nothing(monkeypatch):
+    m = Member('A')
+    saves = []
+    monkeypatch.setattr(m, 'save_data', lambda: saves.append(m.balance))
+    with pytest.raises(RuntimeError):
+        with m.batch():
+            m.add_to_balance(100)
+            raise RuntimeError("failed")
+    assert saves == []
+    assert not Saveable._dirty
+    assert Saveable._batch_depth == 0
+    assert m.balance == 0
+    m.add_to_spent_total(1)
+    m.undo()
+    assert (m.balance, m.spent_total) == (0, 0)
+
+def test_history_budget_and_spill(tmp_path):
+    Member.set_history_budget(max_versions = 3)
+    Saveable.set_global_history_budget(spill_dir = str(tmp_path))
+    try:
+        m = Member('A')
+        start = m.balance
+        for _ in range(10):
+            m.add_to_balance(1)
+        assert len(m._version_history) == 3
+        assert Saveable.history_memory_usage()['Member']['spilled_versions'] >= 7
+        for _ in range(10):
+            m.undo()
+        assert m.balance == start
+    finally:
+        Member.set_history_budget()
+        Saveable.set_global_history_budget()
+
+def test_global_budget_evicts_existing_history():
+    m = Member('A')
+    for _ in range(50):
+        m.add_to_balance(1)
+    try:
+        Saveable.set_global_history_budget(max_bytes = 1000)
+        assert m._history_size[0] <= 1000
+        m.add_to_balance(1)
+        assert m._history_size[0] <= 1000
+        assert len(m._version_history) < 50
+    finally:
+        Saveable.set_global_history_budget()
+
+if __name__ == '__main__':
+    test_member_load()
@@ -0,0 +1,25 @@
+from backend.utils.name_index import NameIndex
+from backend.cls.member_store import MemberStore
+
+def test_prefix_and_typos():
+    index = NameIndex(['Anna', 'anna', 'Annabel', 'John', 'Johnny', 'Jon'])
+    assert index.prefix('ann') == ['Anna', 'anna', 'Annabel']
+    assert index.prefix('JOHN', k = 1) == ['John']
+    # Transposition, substitution and missing letter
+    assert index.search('jhon')[:2] == ['John', 'Johnny']
+    assert 'Annabel' in index.search('anab')
+    assert index.search('jhon', max_typos = 0) == []
+    index.remove('Anna')
+    assert index.prefix('anna') == ['anna', 'Annabel']
+    index.add('Zoe')
+    assert index.search('zeo') == ['Zoe']
+
+def test_store_name_search(tmp_path):
+    store = MemberStore(str(tmp_path))
+    store.save({'id': 'mm9980', 'name': 'Francesca', 'involved_in': []})
+    assert store.search_names('fran') == ['Francesca']
+    store.save({'id': 'mm9981', 'name': 'Franco', 'involved_in': []})
+    store.rename('mm9980', 'Francis')
+    assert store.search_names('fracn') == ['Francis', 'Franco']
+    store.remove('mm9981')
+    assert store.search_names('fran') == ['Francis']
@@ -0,0 +1,94 @@
+from backend.cls.member import Member
+from backend.balance_settler import BalanceSettler
+from backend.settlement_solver import SettleMode, fingerprint, to_cents, min_transfers, exact_min_transfers, greedy_transfers, \
+                                      incremental_adjustments, ADD, CANCEL
+import numpy as np
+
+def check_plan(cents, transfers):
+    settled = np.array(cents, dtype = np.int64)
+    for d, c, amount in transfers:
+        assert amount > 0
+        settled[d] += amount
+        settled[c] -= amount
+    assert not settled.any()
+
+def test_exact_min_transfers():
+    # {-5, 5} and {-10, -20, 30} cancel out: 1 + 2 transfers instead of 4
+    cents = [-5, -10, 30, 5, -20]
+    transfers = exact_min_transfers(cents)
+    check_plan(cents, transfers)
+    assert len(transfers) == 3
+    assert len(exact_min_transfers([0, 0])) == 0
+
+def test_large_group_min_transfers():
+    rng = np.random.default_rng(0)
+    amounts = rng.integers(1, 10000, 200)
+    cents = np.concatenate([amounts, -amounts[::-1]])
+    transfers = min_transfers(cents, time_budget = 0.1)
+    check_plan(cents, transfers)
+    assert len(transfers) == 200
+    check_plan(cents, greedy_transfers(cents))
+
+def test_fingerprint():
+    assert fingerprint({'a': 5, 'b': -5}) == fingerprint({'b': -5, 'a': 5})
+    assert fingerprint({'a': 5, 'b': -5}) != fingerprint({'a': -5, 'b': 5})
+
+def test_to_cents():
+    assert to_cents([0.1, 0.2, -0.3]).sum() == 0
+
+def test_settler_min_transfers():
+    balances = {'S1': -5, 'S2': -10, 'S3': 30, 'S4': 5, 'S5': -20}
+    settler = BalanceSettler([Member(name, balance = b) for name, b in balances.items()])
+    settler.generate_settle_up_transactions(mode = SettleMode.MIN_TRANSFERS)
+    assert len(settler.transactions.pending_transactions) == 3
+    assert all(abs(amount) < 0.01 for amount in settler.partial_amounts.values())
+    assert len(settler.transactions.event_transactions(settler.transactions.event_id)) == 3
+    # Settling the same balances again is detected
+    settler.generate_event_id()
+    assert settler.transactions.numb
+    # Standalone pending transactions are shared between instances
+    for t_id in list(settler.transactions.pending_transactions):
+        settler.transactions.close_transaction(t_id)
+
+def test_settler_fast(monkeypatch):
+    balances = {'S1': -5, 'S2': -10, 'S3': 30, 'S4': 5, 'S5': -20}
+    settler = BalanceSettler([Member(name, balance = b) for name, b in balances.items()])
+    saves = []
+    monkeypatch.setattr(settler.transactions, 'save_data', lambda: saves.append(True))
+    settler.generate_settle_up_transactions(mode = SettleMode.FAST)
+    assert len(settler.transactions.pending_transactions) <= 4
+    assert len(saves) == 1
+    assert all(abs(amount) < 0.01 for amount in settler.partial_amounts.values())
+
+def test_incremental_adjustments():
+    # Balances A: -10, B: +15, C: -5, settled by A and C paying B
+    balances = {'A': -1000, 'B': 1500, 'C': -500, 'D': 0}
+    plan = {('A', 'B'): 1000, ('C', 'B'): 500}
+    deltas = {'A': 300, 'B': -100, 'C': -400, 'D': 200}
+    adjustments = incremental_adjustments(plan, deltas)
+    settled = dict(plan)
+    for kind, d, c, amount in adjustments:
+        assert (kind == ADD) == ((d, c) not in plan)
+        settled[(d, c)] = amount
+    # The adjusted plan settles the new balances
+    for (d, c), amount in settled.items():
+        balances[d] += amount
+        balances[c] -= amount
+    assert all(balances[m] + deltas[m] == 0 for m in balances)
+    assert len(adjustments) <= len(deltas) - 1
+    # Cancelling a transfer entirely
+    assert incremental_adjustments({('A', 'B'): 500}, {'A': 500, 'B': -500}) == [(CANCEL, 'A', 'B', 0)]
+
+def test_settler_resettle():
+    balances = {'S1': -5, 'S2': -10, 'S3': 30, 'S4': 5, 'S5': -20}
+    members = [Member(name, balance = b) for name, b in balances.items()]
+    settler = BalanceSettler(members)
+    settler.generate_settle_up_transactions(mode = SettleMode.MIN_TRANSFERS)
+    s1, s4 = members[0], members[3]
+    # S1 paid 5 more for S4: their transfer isn't needed anymore
+    settler.resettle({s1.id: 5, s4.id: -5})
+    pending = settler.transactions.pending_transactions.values()
+    assert not any(t.sender is s1 or t.receiver is s4 for t in pending)
+    assert len(pending) == 2
+    for t_id in list(settler.transactions.pending_transactions):
+        settler.transactions.close_transaction(t_id)
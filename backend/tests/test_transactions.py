@@ -0,0 +1,160 @@
+from backend.cls.transactions import PendingTransactions, Transaction
+from backend.cls.transaction_history import TransactionHistory
+from backend.cls.member import Member
+from backend.utils.ids import IdFactory
+from backend.tests.test_lists import init_basic_list
+import os, json, gc, gzip
+from datetime import date
+import pytest
+
+def test_history_append_and_stream(tmp_path):
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'), sync_every = 2)
+    history.append([{'id': 'tr0001'}, {'id': 'tr0002'}])
+    history.append([{'id': 'tr0003'}])
+    history.sync()
+    assert [t['id'] for t in history] == ['tr0001','tr0002','tr0003']
+
+def test_history_sync_batching(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'), sync_every = 3)
+    history.append([{'id': 'tr0001'}])
+    history.append([{'id': 'tr0002'}])
+    assert not synced
+    history.append([{'id': 'tr0003'}])
+    assert len(synced) == 1
+    history.append([{'id': 'tr0004'}])
+    # Appends left unsynced are synced when the history goes away
+    del history
+    gc.collect()
+    assert len(synced) == 2
+    assert PendingTransactions(sync_every = 5).history.sync_every == 5
+
+def test_history_migration(tmp_path):
+    with open(os.path.join(tmp_path,'history.json'),'w') as file:
+        json.dump([{'id': 'tr0001'}], file)
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'))
+    assert [t['id'] for t in history] == ['tr0001']
+    assert not os.path.exists(os.path.join(tmp_path,'history.json'))
+
+def test_history_segments(tmp_path):
+    with open(os.path.join(tmp_path,'history.jsonl'),'w') as file:
+        file.write(json.dumps({'id': 'tr0001', 'sender': 'mm0001', 'receiver': 'mm0002', 'amount': 1,
+                               'time_created': '20231215_120000_000000'}) + '\n')
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'))
+    assert not os.path.exists(os.path.join(tmp_path,'history.jsonl'))
+    history.append([{'id': 'tr0002', 'sender': 'mm0001', 'receiver': 'mm0003', 'amount': 2,
+                     'time_created': '20240101_120000_000000', 'time_closed': '20240203_120000_000000'}])
+    reloaded = TransactionHistory(os.path.join(tmp_path,'history.jsonl'))
+    assert sorted(reloaded.index) == ['202312', '202402']
+    assert len(reloaded) == 2
+    assert list(reloaded.segments(member_id = 'mm0003')) == ['202402']
+    assert list(reloaded.segments(start = '20240101_000000_000000')) == ['202402']
+    assert [r['id'] for r in reloaded.query(end = date(2024, 1, 1))] == ['tr0001']
+    assert [r['id'] for r in reloaded] == ['tr0001', 'tr0002']
+    # Appends only rewrite the index of the segments they touch
+    old_index = os.path.join(reloaded.dir_path, '202312.index.json')
+    mtime = os.stat(old_index).st_mtime_ns
+    reloaded.append([{'id': 'tr0003', 'sender': 'mm0002', 'receiver': 'mm0004', 'amount': 3,
+                      'time_created': '20240205_120000_000000'}])
+    assert os.stat(old_index).st_mtime_ns == mtime
+    assert list(TransactionHistory(os.path.join(tmp_path,'history.jsonl')).segments(member_id = 'mm0004')) == ['202402']
+
+def test_history_compaction(tmp_path):
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'), sync_every = 100)
+    records = [{'id': f'tr{k:04d}', 'sender': 'mm0001', 'receiver': 'mm0002', 'amount': k,
+                'time_closed': '20240105_120000_000000'} for k in range(600)]
+    for record in records:
+        history.append([record])
+    assert len(history.index['202401']['blocks']) == 2
+    # Moving to the next month compresses what's left of the previous one
+    history.append([dict(records[0], id = 'tr9999', time_closed = '20240201_120000_000000')])
+    stream = gzip.compress(''.join(json.dumps(r) + '\n' for r in records).encode())
+    assert os.path.getsize(history.segment_path('202401')) < 2*len(stream)
+    reloaded = TransactionHistory(os.path.join(tmp_path,'history.jsonl'))
+    assert reloaded.index['202401']['blocks'] == history.index['202401']['blocks']
+    assert [r['id'] for r in reloaded] == [r['id'] for r in records] + ['tr9999']
+    # Pages resume from the block of their cursor
+    page, cursor = reloaded.page(3, '202401:520')
+    assert [r['amount'] for r in page] == [520, 521, 522]
+    assert cursor == '202401:523'
+
+def test_history_query(tmp_path):
+    history = TransactionHistory(os.path.join(tmp_path,'history.jsonl'))
+    history.append([{'id': f'tr{k:04d}', 'event_id': 'ev' if k < 5 else None, 'sender': 'mm0001', 
+                     'receiver': 'mm0002' if k % 2 else 'mm0003', 'amount': k,
+                     'time_created': f'202401{k+1:02d}_120000_000000', 'time_closed': None} for k in range(10)])
+    assert [r['amount'] for r in history.query(member_id = 'mm0002')] == [1, 3, 5, 7, 9]
+    assert [r['amount'] for r in history.query('mm0001', counterparty = 'mm0003', min_amount = 3)] == [4, 6, 8]
+    assert len(list(history.query(event_id = 'ev', max_amount = 2))) == 3
+    assert [r['amount'] for r in history.query(start = '2024-01-03', end = date(2024, 1, 5))] == [2, 3]
+    pages, cursor = [], None
+    while True:
+        records, cursor = history.page(4, cursor, member_id = 'mm0001')
+        pages.append([r['amount'] for r in records])
+        if cursor is None:
+            break
+    assert pages == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    with pytest.raises(ValueError):
+        list(history.query(counterparty = 'mm0002'))
+
+def test_close_transaction():
+    m1 = Member('A')
+    m2 = Member('B')
+    pending = PendingTransactions()
+    t = Transaction(sender = m1, receiver = m2, amount = 5)
+    pending.add_transaction(t)
+    pending.close_transaction(t.id)
+    assert len(pending.pending_transactions) == 0
+    assert list(pending.history)[-1]['id'] == t.id
+
+def test_member_indexes_and_load():
+    ls = init_basic_list()
+    a, b = ls.members.get_by_name('A'), ls.members.get_by_name('B')
+    pending = PendingTransactions(owner = ls)
+    pending.set_event_id('ev1')
+    t1 = Transaction(sender = a, receiver = b, amount = 5)
+    t2 = Transaction(sender = b, receiver = a, amount = 2)
+    pending.add_transactions([t1, t2])
+    assert pending.sent_transactions(a.id) == [t1]
+    assert pending.received_transactions(a.id) == [t2]
+    assert pending.member_transactions(a.id, event_id = True) == [t1, t2]
+    # Loading resolves the members through the owner
+    loaded = PendingTransactions(owner = ls)
+    assert loaded.sent_transactions(b.id)[0].sender is b
+    assert len(loaded.event_transactions('ev1')) == 2
+    pending.close_transaction(t1.id)
+    assert pending.sent_transactions(a.id) == []
+    pending.undo()
+    assert pending.sent_transactions(a.id) == [t1]
+
+def test_close_all(monkeypatch):
+    ls = init_basic_list()
+    a, b = ls.members.get_by_name('A'), ls.members.get_by_name('B')
+    pending = PendingTransactions(owner = ls)
+    pending.set_event_id('ev2')
+    pending.add_transactions([Transaction(sender = a, receiver = b, amount = 1) for _ in range(20)])
+    pending.set_event_id('ev3')
+    pending.add_transaction(Transaction(sender = b, receiver = a, amount = 4))
+    balance = a.balance
+    appends = []
+    monkeypatch.setattr(pending.history, 'append', lambda records: appends.append(len(records)))
+    assert len(pending.close_all(event_id = 'ev2')) == 20
+    assert appends == [20]
+    assert a.balance == balance + 20
+    assert len(pending.close_all(member_id = a.id)) == 1
+    assert pending.close_all() == []
+    assert len(pending.pending_transactions) == 0
+
+def test_ids_reserved_in_blocks(monkeypatch):
+    saves = []
+    monkeypatch.setattr(IdFactory, '_save_ids', lambda: saves.append(1))
+    m1 = Member('A')
+    m2 = Member('B')
+    ids = {Transaction(sender = m1, receiver = m2, amount = 1).id for _ in range(2500)}
+    assert len(ids) == 2500
+    assert len(saves) <= 3
+
+
+if __name__ == '__main__':
+    test_close_transaction()
@@ -0,0 +1,159 @@
+import numpy as np
+
+from backend.utils.time import to_date
+
+class FenwickTree:
+    """
+    Binary indexed tree over vectors: each of the 'size' positions (1-based)
+    holds a vector of 'width' values. Point updates and prefix sums cost
+    O(log(size)) vector operations.
+    """
+    def __init__(self, size, width):
+        self.tree = np.zeros((size + 1, width))
+
+    size = property(lambda self: self.tree.shape[0] - 1)
+    width = property(lambda self: self.tree.shape[1])
+
+    def add(self, pos, columns, values):
+        """
+        Add 'values' to the given columns of position 'pos'.
+        """
+        while pos <= self.size:
+            self.tree[pos, columns] += values
+            pos += pos & -pos
+
+    def prefix(self, pos):
+        """
+        Sum of the vectors of positions 1..pos.
+        """
+        pos = min(pos, self.size)
+        total = np.zeros(self.width)
+        while pos > 0:
+            total += self.tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def range(self, lo, hi):
+        """
+        Sum of the vectors of positions lo..hi (inclusive).
+        """
+        if hi < lo:
+            return np.zeros(self.width)
+        return self.prefix(hi) - self.prefix(lo - 1)
+
+    def to_array(self):
+        """
+        Return the (size x width) array of the values at each position, in O(size).
+        """
+        values = self.tree.copy()
+        for pos in range(self.size, 0, -1):
+            parent = pos + (pos & -pos)
+            if parent <= self.size:
+                values[parent] -= values[pos]
+        return values[1:]
+
+    @classmethod
+    def from_array(cls, values):
+        """
+        Build the tree of a (size x width) array of values in O(size).
+        """
+        size, width = values.shape
+        fenwick = cls(size, width)
+        fenwick.tree[1:] = values
+        for pos in range(1, size + 1):
+            parent = pos + (pos & -pos)
+            if parent <= size:
+                fenwick.tree[parent] += fenwick.tree[pos]
+        return fenwick
+
+
+class TemporalIndex:
+    """
+    Index of per-member values over days, with one Fenwick tree per channel (e.g.
+    'balance' and 'spent_total'). Adding the values of a day and querying the totals
+    of all the members over a range of days both cost O(log(days)).
+    The covered days and the member columns grow (by doubling) as needed.
+    """
+    def __init__(self, channels = ('balance',)):
+        self.channels = channels
+        # Column of each member in the trees
+        self.columns = {}
+        # Ordinal of the day at position 1
+        self.epoch = None
+        self.trees = {channel: FenwickTree(0, 1) for channel in channels}
+
+    @property
+    def n_days(self):
+        return self.trees[self.channels[0]].size
+
+    def add(self, day, values: dict):
+        """
+        Add the values of each channel ({channel: {member_id: value}}) to the given day.
+        """
+        pos = self._position(to_date(day).toordinal())
+        for channel, deltas in values.items():
+            if not deltas:
+                continue
+            columns = [self._column(key) for key in deltas]
+            self.trees[channel].add(pos, columns, np.fromiter(deltas.values(), dtype = float, count = len(deltas)))
+
+    def query(self, channel, start = None, end = None):
+        """
+        Totals of each member between the days 'start' and 'end' (inclusive, None for unbounded).
+        """
+        tree = self.trees[channel]
+        if self.epoch is None:
+            return {key: 0. for key in self.columns}
+        lo = 1 if start is None else max(to_date(start).toordinal() - self.epoch + 1, 1)
+        hi = tree.size if end is None else to_date(end).toordinal() - self.epoch + 1
+        totals = tree.range(lo, hi)
+        return {key: float(totals[col]) for key, col in self.columns.items()}
+
+    @classmethod
+    def from_points(cls, points, channels = ('balance',)):
+        """
+        Build the index at once from (day, {channel: {member_id: value}}) points.
+        """
+        index = cls(channels)
+        points = [(to_date(day).toordinal(), values) for day, values in points]
+        if not points:
+            return index
+        index.epoch = min(day for day, _ in points)
+        n_days = max(day for day, _ in points) - index.epoch + 1
+        for _, values in points:
+            for deltas in values.values():
+                for key in deltas:
+                    index.columns.setdefault(key, len(index.columns))
+        arrays = {channel: np.zeros((n_days, max(len(index.columns), 1))) for channel in channels}
+        for day, values in points:
+            for channel, deltas in values.items():
+                for key, value in deltas.items():
+                    arrays[channel][day - index.epoch, index.columns[key]] += value
+        index.trees = {channel: FenwickTree.from_array(array) for channel, array in arrays.items()}
+        return index
+
+    def _column(self, key):
+        if key not in self.columns:
+            self.columns[key] = len(self.columns)
+            width = self.trees[self.channels[0]].width
+            if len(self.columns) > width:
+                self._resize(pad_columns = width)
+        return self.columns[key]
+
+    def _position(self, day):
+        if self.epoch is None:
+            self.epoch = day
+        if day < self.epoch:
+            # Grow to the left, keeping some room for earlier days
+            shift = max(self.epoch - day, self.n_days)
+            self._resize(pad_before = shift)
+            self.epoch -= shift
+        pos = day - self.epoch + 1
+        if pos > self.n_days:
+            self._resize(pad_after = max(pos - self.n_days, self.n_days))
+        return pos
+
+    def _resize(self, pad_before = 0, pad_after = 0, pad_columns = 0):
+        for channel, tree in self.trees.items():
+            values = np.pad(tree.to_array(), ((pad_before, pad_after), (0, pad_columns)))
+            self.trees[channel] = FenwickTree.from_array(values)
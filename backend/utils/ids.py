@@ -48,18 +48,27 @@ default_ids = {
 }
 
 class IdFactory:
+    """
+    Ids are handed out from blocks of 'block_size' reserved ids. The ids file only
+    stores, for each type, the upper limit of the reserved block (the high-water mark),
+    so it's written once per block instead of once per id. Ids of a block that
+    were not used before shutdown are simply lost.
+    """
+    block_size = 1000
     file_path = os.path.join(prefs.data_dir,'id_factory','ids.json')
     try:
         with open(file_path,'r') as file:
             next_ids = json.load(file)
     except FileNotFoundError:
-        next_ids = default_ids
+        next_ids = dict(default_ids)
         dir_name = os.path.dirname(file_path)
         if not os.path.exists(dir_name):
             os.makedirs(dir_name)
     # Convert strings to ids
     for key,value in next_ids.items():
         next_ids[key] = Id(value)
+    # Nothing is reserved until the first id of each type is requested
+    reserved_ids = dict(next_ids)
 
     @staticmethod
     def check_id_against_type(obj_type, id):
@@ -87,6 +96,7 @@ class IdFactory:
             try:
                 id = default_ids[obj_type]
                 IdFactory.next_ids[obj_type] = id
+                IdFactory.reserved_ids[obj_type] = id
                 IdFactory._increment_ids(obj_type)
             except KeyError:
                 raise ValueError(f"Object of type {obj_type} is not eligible for id assignment.")
@@ -97,6 +107,7 @@ class IdFactory:
         """
         Roll back the last id assigned to an object type. If the object given as argument was not the last of its
         kind to receive an id, this method will raise an error.
+        The id stays within the current block, so nothing needs to be saved.
         """
         obj_type = type(obj).__name__
         try:
@@ -104,24 +115,29 @@ class IdFactory:
             id = IdFactory.next_ids[obj_type]
             assert id.numeral == previous_id.numeral + 1, "Id cannot be rolled back, this is a bug" 
             IdFactory.next_ids[obj_type] = previous_id
-            IdFactory._save_ids()
         except KeyError:
             raise ValueError(f"Object of type {obj_type} is not eligible for id assignment.")
 
+    @staticmethod
+    def _make_id(literal, numeral):
+        # Ensure Ids contain at least 4 digits
+        return Id(literal + (f'{numeral:04d}' if numeral < 10000 else f'{numeral}'))
     
     def _increment_ids(name):
         id = IdFactory.next_ids[name]
-        id_N = id.numeral + 1
-        # Ensure Ids contain at least 4 digits
-        id_N = f'{id_N:04d}' if id_N < 10000 else f'{id_N}'
-        next_id = Id(id.literal + id_N)
+        next_id = IdFactory._make_id(id.literal, id.numeral + 1)
         IdFactory.next_ids[name] = next_id
-        IdFactory._save_ids()
+        if next_id.numeral > IdFactory.reserved_ids[name].numeral:
+            IdFactory._reserve_block(name)
 
+    def _reserve_block(name):
+        id = IdFactory.next_ids[name]
+        IdFactory.reserved_ids[name] = IdFactory._make_id(id.literal, id.numeral + IdFactory.block_size)
+        IdFactory._save_ids()
     
     def _save_ids():
         with open(IdFactory.file_path,'w+') as file:
-            json.dump(IdFactory.next_ids, file, indent = 4)
+            json.dump(IdFactory.reserved_ids, file, indent = 4)
 
 
 def is_uuid4(id:str):
@@ -1,6 +1,9 @@
 from enum import Enum
 from datetime import datetime
+import atexit
 import sys
+import threading
+import time
 
 class LogLevel(Enum):
     DIAGNOSTIC = 0
@@ -13,12 +16,76 @@ class LogLevel(Enum):
     def __le__(self,other):
         if isinstance(other,LogLevel):
             return self.value <= other.value
+        return NotImplemented
+
+    def __lt__(self,other):
+        if isinstance(other,LogLevel):
+            return self.value < other.value
+        return NotImplemented
+
+class LogSink:
+    """
+    Buffered output of the loggers. Records are written to 'stream' (stdout by default)
+    at most every 'flush_interval' seconds, or when 'buffer_size' records are waiting,
+    or right away for records at 'flush_level' or above. With 'background' the periodic
+    flushes are done by a daemon thread, so a quiet logger doesn't keep records waiting.
+    A flush_interval of 0 writes every record right away.
+    """
+    def __init__(self, stream = None, flush_interval = 0, buffer_size = 1000, 
+                 flush_level = LogLevel.ERROR, background = False):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.flush_level = flush_level
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        if background and flush_interval > 0:
+            self._thread = threading.Thread(target = self._run, name = 'LogSink', daemon = True)
+            self._thread.start()
+
+    def write(self, text, level = None):
+        with self._lock:
+            self._buffer.append(text)
+            if (len(self._buffer) < self.buffer_size and self.flush_interval > 0 and 
+                (level is None or level < self.flush_level) and
+                (self._thread is not None or time.monotonic() - self._last_flush < self.flush_interval)):
+                return
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        # Resolved at every flush, stdout may be replaced (e.g. when captured by tests)
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(''.join(self._buffer))
+        stream.flush()
+        self._buffer = []
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
 
 class Logger:
 
     # Static variable to hold the logging level.
     level = LogLevel.WARNING
     use_timestamps = False
+    # Shared output of all the loggers
+    sink = LogSink()
 
     def __init__(self, name = None):
         """
@@ -26,13 +93,22 @@ class Logger:
         """
         self.name = name
 
-    def log(self, level, message):
-        """
-        Log a message at the specified level.
-        """
-        if self.level <= level:
-            sys.stdout.write(self.format_message(level, message))
-            sys.stdout.flush()
+    def is_enabled_for(self, level):
+        return self.level <= level
+
+    def log(self, level, message, *args):
+        """
+        Log a message at the specified level. Formatting is deferred until the level
+        is known to be enabled: the message can be a callable returning the message,
+        or a %-style format string for 'args'.
+        """
+        if not self.level <= level:
+            return
+        if callable(message):
+            message = message()
+        elif args:
+            message = message % args
+        Logger.sink.write(self.format_message(level, message), level)
 
     def format_message(self, level, message):
         """
@@ -43,41 +119,41 @@ class Logger:
             return f"{timestamp} {level.name}\t{self.name}: {message}\n"
         return f"{level.name}\t{self.name}: {message}\n"
 
-    def diagnostic(self, message):
+    def diagnostic(self, message, *args):
         """
         Log a message at the DIAGNOSTIC level.
         """
-        self.log(LogLevel.DIAGNOSTIC, message)
+        self.log(LogLevel.DIAGNOSTIC, message, *args)
     
-    def debug(self, message):
+    def debug(self, message, *args):
         """
         Log a message at the DEBUG level.
         """
-        self.log(LogLevel.DEBUG, message)
+        self.log(LogLevel.DEBUG, message, *args)
     
-    def info(self, message):
+    def info(self, message, *args):
         """
         Log a message at the INFO level.
         """
-        self.log(LogLevel.INFO, message)
+        self.log(LogLevel.INFO, message, *args)
 
-    def warning(self, message):
+    def warning(self, message, *args):
         """
         Log a message at the WARNING level.
         """
-        self.log(LogLevel.WARNING, message)
+        self.log(LogLevel.WARNING, message, *args)
     
-    def error(self, message):
+    def error(self, message, *args):
         """
         Log a message at the ERROR level.
         """
-        self.log(LogLevel.ERROR, message)
+        self.log(LogLevel.ERROR, message, *args)
     
-    def critical(self, message):
+    def critical(self, message, *args):
         """
         Log a message at the CRITICAL level.
         """
-        self.log(LogLevel.CRITICAL, message)
+        self.log(LogLevel.CRITICAL, message, *args)
 
     @staticmethod
     def set_log_level(level):
@@ -86,10 +162,19 @@ class Logger:
         """
         if level in LogLevel:
             Logger.level = level
-            sys.stdout.write(f"Set log level to {level.name}\n")
-            sys.stdout.flush()
+            Logger.sink.write(f"Set log level to {level.name}\n")
         else:
             raise ValueError(f"Invalid log level: {level}")
+
+    @staticmethod
+    def configure_sink(flush_interval = 0, buffer_size = 1000, flush_level = LogLevel.ERROR, 
+                       background = False, stream = None):
+        """
+        Replace the shared sink of the loggers (see LogSink), flushing the previous one.
+        """
+        Logger.sink.close()
+        Logger.sink = LogSink(stream, flush_interval, buffer_size, flush_level, background)
+
     @staticmethod
     def using_timestamps(use_timestamps:bool):
         if isinstance(use_timestamps,bool):
@@ -99,6 +184,8 @@ class Logger:
             sys.stdout.flush()
 
 
+atexit.register(lambda: Logger.sink.close())
+
 def get_logger(name):
     """
     Get a logger with the specified name.
@@ -0,0 +1,115 @@
+import bisect
+from collections import Counter
+
+class NameIndex:
+    """
+    Case-insensitive index of names for type-ahead queries. The casefolded names are kept
+    sorted, so the names starting with a prefix are a contiguous range found by binary search
+    (the same ranges a trie would give, without its per-node memory). Typo-tolerant queries
+    look up the prefixes within a few edits of the query, so their cost depends on the length
+    of the query and not on the number of names.
+    The same name can be added more than once (e.g. by different members), it's
+    removed once it has been removed as many times.
+    """
+    def __init__(self, names = ()):
+        # casefolded name -> {name: count}
+        self._names = {}
+        for name in names:
+            self._names.setdefault(name.casefold(), Counter())[name] += 1
+        self._sorted_keys = sorted(self._names)
+        # Characters used to generate the typo variants of a query
+        self._alphabet = set(''.join(self._sorted_keys))
+
+    def add(self, name):
+        key = name.casefold()
+        if key not in self._names:
+            self._names[key] = Counter()
+            bisect.insort(self._sorted_keys, key)
+            self._alphabet.update(key)
+        self._names[key][name] += 1
+
+    def remove(self, name):
+        key = name.casefold()
+        names = self._names.get(key)
+        if not names or name not in names:
+            return
+        names[name] -= 1
+        if names[name] <= 0:
+            del names[name]
+        if not names:
+            del self._names[key]
+            del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+
+    def _prefix_keys(self, prefix, k):
+        """
+        Up to 'k' (casefolded) names starting with 'prefix'.
+        """
+        keys = []
+        position = bisect.bisect_left(self._sorted_keys, prefix)
+        while len(keys) < k and position < len(self._sorted_keys):
+            key = self._sorted_keys[position]
+            if not key.startswith(prefix):
+                break
+            keys.append(key)
+            position += 1
+        return keys
+
+    def _key_names(self, keys, k):
+        names = []
+        for key in keys:
+            names.extend(sorted(self._names[key]))
+            if len(names) >= k:
+                break
+        return names[:k]
+
+    def _edits(self, word):
+        """
+        Prefixes one deletion, transposition, substitution or insertion away from 'word'.
+        Substituting the last character or appending one is left out: the names matched
+        by those prefixes are already matched by the deletion of the last character.
+        """
+        splits = [(word[:i], word[i:]) for i in range(len(word))]
+        edits = {a + b[1:] for a, b in splits}
+        edits.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+        edits.update(a + c + b[1:] for a, b in splits[:-1] for c in self._alphabet)
+        edits.update(a + c + b for a, b in splits for c in self._alphabet)
+        edits.discard(word)
+        return edits
+
+    def prefix(self, prefix, k = 10):
+        """
+        Up to 'k' names starting with 'prefix' (case-insensitive), in alphabetical order.
+        """
+        return self._key_names(self._prefix_keys(prefix.casefold(), k), k)
+
+    def search(self, query, k = 10, max_typos = 1):
+        """
+        Up to 'k' names matching 'query': names starting with it come first, then names
+        starting with a string 1, 2, ... 'max_typos' edits away from it (in alphabetical order
+        for the same number of edits). The number of variants grows very quickly with
+        'max_typos', more than 1 or 2 is not meant for type-ahead.
+        """
+        query = query.casefold()
+        keys = self._prefix_keys(query, k)
+        found = set(keys)
+        seen, variants = {query}, {query}
+        for _ in range(max_typos):
+            if len(keys) >= k:
+                break
+            variants = {edit for variant in variants for edit in self._edits(variant)} - seen
+            seen.update(variants)
+            matches = set()
+            for variant in variants:
+                # An empty variant would match every name
+                if variant:
+                    matches.update(key for key in self._prefix_keys(variant, k) if key not in found)
+            new_keys = sorted(matches)
+            keys.extend(new_keys)
+            found.update(new_keys)
+        return self._key_names(keys, k)
+
+    def __contains__(self, name):
+        return name in self._names.get(name.casefold(), ())
+
+    def __len__(self):
+        return sum(sum(names.values()) for names in self._names.values())
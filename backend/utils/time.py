@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, date
 import re
 
 def get_timestamp_numerical():
@@ -13,4 +13,30 @@ def convert_timestamp_readable(timestamp):
 
 def is_valid_timestamp(timestamp_str):
     timestamp_format = r'\d{8}_\d{6}_\d{6}'  # Adjust the pattern based on your expected format
-    return bool(re.fullmatch(timestamp_format, timestamp_str))
\ No newline at end of file
+    return bool(re.fullmatch(timestamp_format, timestamp_str))
+
+def to_date(value):
+    """
+    Convert a numerical timestamp (as returned by get_timestamp_numerical), 
+    an ISO date string, a datetime or a date to a date.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if is_valid_timestamp(value):
+        return datetime.strptime(value,"%Y%m%d_%H%M%S_%f").date()
+    return date.fromisoformat(value)
+
+def to_timestamp_numerical(value):
+    """
+    Convert a numerical timestamp, an ISO date(time) string, a datetime or a date 
+    (taken at midnight) to a numerical timestamp, which sorts chronologically as a string.
+    """
+    if isinstance(value, str):
+        if is_valid_timestamp(value):
+            return value
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value.strftime("%Y%m%d_%H%M%S_%f")
@@ -10,6 +10,7 @@ setup(
     install_requires=[
         # List your dependencies here
         # Example: 'requests>=2.0'
+        'numpy',
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',